@@ -1,119 +1,2420 @@
+import argparse
+import asyncio
+import bisect
 import collections
+import concurrent.futures
+import contextlib
 import email.utils
+import functools
+import hashlib
+import importlib
 from http import HTTPStatus
 import io
+import json
+import multiprocessing
+import os
+import queue
+import random
+import re
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
 import typing
 
-import httpolice
 from mitmproxy import ctx
+import mitmproxy.exceptions
 import mitmproxy.flow
 import mitmproxy.http
+import mitmproxy.io
+import mitmproxy.io.tnetstring
+import mitmproxy.master
 import mitmproxy.net.http
+import mitmproxy.options
 import mitmproxy.types
 
 
 __version__ = '0.10.0.dev1'
 
 
+class LazyModule:
+
+    """A module that is only imported when one of its attributes is used.
+
+    Importing HTTPolice takes a while, and mitmproxy imports this script
+    on every start and reload, often without checking any flows soon.
+    So HTTPolice is imported when it's first needed, or in the background
+    after mitmproxy has started (see `warm_up`). Attributes are then
+    remembered, so using them later costs no more than with a real module.
+
+    """
+
+    def __init__(self, name):
+        self.__name = name
+
+    def __getattr__(self, attr):
+        # Only called for attributes we haven't remembered yet.
+        # ``import_module`` is thread-safe and a no-op after the first time.
+        value = getattr(importlib.import_module(self.__name), attr)
+        setattr(self, attr, value)
+        return value
+
+
+httpolice = LazyModule('httpolice')
+
+
 class MitmproxyHTTPolice:
 
+    # The most flows that ``/+httpolice/index`` will show.
+    max_index_limit = 1000
+
+    def __init__(self):
+        self.last_report = None
+        self.background_report = None
+        self.pool = None
+        self.cache = ResultCache()
+        self.sampler = Sampler()
+        self.fingerprints = FingerprintCache()
+        self.related = RelatedFlows()
+        self.jsonl = None
+        self.exporter = None
+        self.coalescer = None
+        self.index = None
+        self.counters = collections.Counter()
+        self.notice_stats = NoticeStats()
+        self.stage_times = StageTimes()
+        self.live_report = LiveReport()
+        self.policy = Policy()
+        self.selection = Selection()
+        # Flows whose response headers we've checked with httpolice_early,
+        # by ID, to reuse the result if the body never comes.
+        self.early = {}
+
+    def load(self, loader):
+        loader.add_option(
+            name='httpolice_silence',
+            # ``typing.Sequence[int]`` would be better, but is not supported.
+            typespec=typing.Sequence[str],
+            default=[],
+            help='Silence these HTTPolice notice IDs.',
+        )
+        loader.add_option(
+            name='httpolice_mark',
+            # Could make this a ``typing.Optional[str]``, but
+            # that doesn't work well with the interactive editors,
+            # so make "disable" an explicit choice.
+            typespec=str,
+            # Spelled out, so as not to import HTTPolice just for this.
+            # `parse_severity` will complain if HTTPolice disagrees.
+            choices=['', 'debug', 'comment', 'error'],
+            default='',
+            help=
+                'Mark flows where HTTPolice found notices of this severity '
+                'or higher (empty to disable).'
+        )
+        loader.add_option(
+            name='httpolice_silence_rules',
+            typespec=typing.Sequence[str],
+            default=[],
+            help=
+                'Silence HTTPolice notice IDs only on some flows, '
+                'like "example.com/api/=1277,1110". The part before "=" '
+                'is a host (or "*.example.com" for subdomains, '
+                'or "*" for any), optionally followed by a path prefix.'
+        )
+        loader.add_option(
+            name='httpolice_mark_rules',
+            typespec=typing.Sequence[str],
+            default=[],
+            help=
+                'Override httpolice_mark on some flows, '
+                'like "*.example.com/legacy/=error" (see '
+                'httpolice_silence_rules); empty after "=" to not mark them.'
+        )
+        loader.add_option(
+            name='httpolice_workers',
+            typespec=int,
+            default=0,
+            help=
+                'Check flows in this many background threads, '
+                'so that mitmproxy does not wait for HTTPolice '
+                '(0 to check every flow before passing it on).'
+        )
+        loader.add_option(
+            name='httpolice_queue',
+            typespec=int,
+            default=1000,
+            help=
+                'Maximum number of flows waiting to be checked '
+                'in the background (see httpolice_workers).'
+        )
+        loader.add_option(
+            name='httpolice_queue_full',
+            typespec=str,
+            choices=['wait', 'drop'],
+            default='wait',
+            help=
+                'What to do with a flow when the background queue is full: '
+                'check it before passing it on, or do not check it at all.'
+        )
+        loader.add_option(
+            name='httpolice_early',
+            typespec=bool,
+            default=False,
+            help=
+                'Check headers as soon as they arrive, and show the notices '
+                'until the body has arrived and the whole flow is checked.'
+        )
+        loader.add_option(
+            name='httpolice_cache',
+            typespec=int,
+            default=0,
+            help=
+                'Approximate size (in bytes of headers and bodies) '
+                'of checked flows to remember, so that reports on them '
+                'do not have to check them again (0 to disable). '
+                'Actual memory use may be several times that.'
+        )
+        loader.add_option(
+            name='httpolice_report_memory',
+            typespec=int,
+            default=16 * 1024 * 1024,
+            help=
+                'Maximum size (in bytes) of an in-memory report to keep '
+                'in RAM; bigger reports are moved to a temporary file.'
+        )
+        loader.add_option(
+            name='httpolice_report_severity',
+            typespec=str,
+            choices=['', 'debug', 'comment', 'error'],
+            default='',
+            help=
+                'Include in reports only flows with notices '
+                'of this severity or higher (empty for all flows).'
+        )
+        loader.add_option(
+            name='httpolice_report_ids',
+            typespec=typing.Sequence[str],
+            default=[],
+            help=
+                'Include in reports only flows with these notice IDs '
+                '(empty for all flows).'
+        )
+        loader.add_option(
+            name='httpolice_report_hosts',
+            typespec=typing.Sequence[str],
+            default=[],
+            help=
+                'Include in reports only flows to these hosts, like '
+                '"*.example.com/api/" (see httpolice_silence_rules; '
+                'empty for all flows).'
+        )
+        loader.add_option(
+            name='httpolice_report_jobs',
+            typespec=int,
+            default=0,
+            help=
+                'Produce reports in the background, checking flows '
+                'in this many worker processes (0 to produce them '
+                'before returning to mitmproxy).'
+        )
+        loader.add_option(
+            name='httpolice_max_body',
+            typespec=int,
+            default=0,
+            help=
+                'Do not check bodies bigger than this many bytes, '
+                'only headers (0 for no limit).'
+        )
+        loader.add_option(
+            name='httpolice_body_types',
+            typespec=typing.Sequence[str],
+            default=[],
+            help=
+                'Only check bodies with these media types, '
+                'such as "application/json" or "text/*" '
+                '(empty to check all bodies).'
+        )
+        loader.add_option(
+            name='httpolice_sample',
+            typespec=int,
+            default=100,
+            help='Check only this percentage of flows, chosen at random.'
+        )
+        loader.add_option(
+            name='httpolice_rate',
+            typespec=int,
+            default=0,
+            help=
+                'Check at most this many flows per second '
+                'to the same host and path (0 for no limit).'
+        )
+        loader.add_option(
+            name='httpolice_first',
+            typespec=int,
+            default=0,
+            help=
+                'Check only the first this many flows with the same method, '
+                'host, path and status code (0 for no limit). '
+                'Numbers and IDs in paths are ignored.'
+        )
+        loader.add_option(
+            name='httpolice_dedupe',
+            typespec=int,
+            default=0,
+            help=
+                'Remember the notices for this many distinct kinds of flows, '
+                'and reuse them for flows that look the same, instead of '
+                'checking them again (0 to disable). Flows look the same '
+                'if they differ only in IDs in paths, query strings, '
+                'or volatile headers like Date.'
+        )
+        loader.add_option(
+            name='httpolice_related',
+            typespec=int,
+            default=0,
+            help=
+                'Remember the latest responses for this many resources, '
+                'to find problems that span several flows, such as '
+                'a strong ETag reused for a different body (0 to disable).'
+        )
+        loader.add_option(
+            name='httpolice_jsonl',
+            typespec=str,
+            default='',
+            help=
+                'Append a JSON record with the notices on every checked flow '
+                'to this file (empty to disable).'
+        )
+        loader.add_option(
+            name='httpolice_export',
+            typespec=str,
+            default='',
+            help=
+                'Send a JSON record with the notices on every checked flow '
+                'to a collector, in batches: "unix:/path/to/socket", '
+                '"tcp:host:port", or "dir:/path/to/spool" for a file '
+                'per batch (empty to disable).'
+        )
+        loader.add_option(
+            name='httpolice_export_batch',
+            typespec=int,
+            default=100,
+            help=
+                'Send records to httpolice_export '
+                'when there are this many of them...'
+        )
+        loader.add_option(
+            name='httpolice_export_interval',
+            typespec=int,
+            default=1000,
+            help=
+                '...or when the oldest of them is this many milliseconds old.'
+        )
+        loader.add_option(
+            name='httpolice_index',
+            typespec=str,
+            default='',
+            help=
+                'Save every checked flow to "<this path>.flows", and '
+                'a summary of its notices to an SQLite database at this path, '
+                'for httpolice.index.report and /+httpolice/index '
+                '(empty to disable).'
+        )
+        loader.add_option(
+            name='httpolice_log_window',
+            typespec=int,
+            default=0,
+            help=
+                'Instead of logging every flow with notices, log a summary '
+                'of similar flows every this many seconds (0 to disable).'
+        )
+        loader.add_option(
+            name='httpolice_log_lines',
+            typespec=int,
+            default=20,
+            help=
+                'Log at most this many summaries every httpolice_log_window '
+                'seconds; the rest are only counted.'
+        )
+        loader.add_option(
+            name='httpolice_timing',
+            typespec=bool,
+            default=False,
+            help=
+                'Measure how long each stage of checking a flow takes '
+                '(see httpolice.stats).'
+        )
+        loader.add_option(
+            name='httpolice_slow',
+            typespec=int,
+            default=0,
+            help=
+                'Log flows that take longer than this many milliseconds '
+                'to check, with a breakdown by stage (0 to disable).'
+        )
+        loader.add_option(
+            name='httpolice_live',
+            typespec=int,
+            default=0,
+            help=
+                'Keep an HTML report on this many most recently checked '
+                'flows, to be served at /+httpolice/ (0 to disable).'
+        )
+        loader.add_option(
+            name='httpolice_live_size',
+            typespec=int,
+            default=16 * 1024 * 1024,
+            help=
+                'Maximum size (in bytes) of the report kept '
+                'with httpolice_live.'
+        )
+
+    def configure(self, updated):
+        if updated & {'httpolice_silence', 'httpolice_silence_rules',
+                      'httpolice_mark', 'httpolice_mark_rules'}:
+            try:
+                self.policy = Policy(ctx.options.httpolice_silence,
+                                     ctx.options.httpolice_silence_rules,
+                                     ctx.options.httpolice_mark,
+                                     ctx.options.httpolice_mark_rules)
+            except ValueError as exc:
+                raise mitmproxy.exceptions.OptionsError(
+                    f'Bad HTTPolice option: {exc}')
+        if updated & {'httpolice_report_severity', 'httpolice_report_ids',
+                      'httpolice_report_hosts'}:
+            try:
+                self.selection = Selection(
+                    ctx.options.httpolice_report_severity,
+                    ctx.options.httpolice_report_ids,
+                    ctx.options.httpolice_report_hosts)
+            except ValueError as exc:
+                raise mitmproxy.exceptions.OptionsError(
+                    f'Bad HTTPolice option: {exc}')
+        if updated & {'httpolice_silence', 'httpolice_silence_rules',
+                      'httpolice_max_body', 'httpolice_body_types'}:
+            # Remembered results were checked with the old options.
+            self.cache.clear()
+            self.fingerprints.clear()
+        if 'httpolice_dedupe' in updated:
+            self.fingerprints.resize(ctx.options.httpolice_dedupe)
+        if 'httpolice_cache' in updated:
+            self.cache.resize(ctx.options.httpolice_cache)
+        if 'httpolice_related' in updated:
+            self.related.resize(ctx.options.httpolice_related)
+        if updated & {'httpolice_rate', 'httpolice_first'}:
+            self.sampler = Sampler()
+        if updated & {'httpolice_live', 'httpolice_live_size'}:
+            self.live_report.resize(ctx.options.httpolice_live,
+                                    ctx.options.httpolice_live_size)
+        if 'httpolice_workers' in updated:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+            if ctx.options.httpolice_workers > 0:
+                self.pool = CheckPool(ctx.options.httpolice_workers)
+        if 'httpolice_jsonl' in updated:
+            if self.jsonl is not None:
+                self.jsonl.close()
+                self.jsonl = None
+            if ctx.options.httpolice_jsonl:
+                try:
+                    self.jsonl = LineWriter(
+                        os.path.expanduser(ctx.options.httpolice_jsonl))
+                except OSError as exc:
+                    raise mitmproxy.exceptions.OptionsError(
+                        f'Cannot open httpolice_jsonl: {exc}')
+        if 'httpolice_index' in updated:
+            if self.index is not None:
+                self.index.close()
+                self.index = None
+            if ctx.options.httpolice_index:
+                try:
+                    self.index = ResultIndex(
+                        os.path.expanduser(ctx.options.httpolice_index))
+                except (OSError, sqlite3.Error) as exc:
+                    raise mitmproxy.exceptions.OptionsError(
+                        f'Cannot open httpolice_index: {exc}')
+        if updated & {'httpolice_log_window', 'httpolice_log_lines'}:
+            if self.coalescer is not None:
+                self.coalescer.flush()
+                self.coalescer = None
+            if ctx.options.httpolice_log_window > 0:
+                self.coalescer = LogCoalescer(ctx.options.httpolice_log_window,
+                                              ctx.options.httpolice_log_lines)
+        if updated & {'httpolice_export', 'httpolice_export_batch',
+                      'httpolice_export_interval'}:
+            if self.exporter is not None:
+                self.counters['export lost'] += self.exporter.close()
+                self.exporter = None
+            if ctx.options.httpolice_export:
+                try:
+                    self.exporter = BatchExporter(
+                        parse_destination(ctx.options.httpolice_export),
+                        ctx.options.httpolice_export_batch,
+                        ctx.options.httpolice_export_interval / 1000)
+                except ValueError as exc:
+                    raise mitmproxy.exceptions.OptionsError(
+                        f'Bad httpolice_export: {exc}')
+
+    def running(self):
+        threading.Thread(target=warm_up, daemon=True,
+                         name='HTTPolice warm-up').start()
+
+    def done(self):
+        if self.background_report is not None:
+            self.background_report.cancel()
+            self.background_report = None
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        if self.jsonl is not None:
+            self.jsonl.close()
+            self.jsonl = None
+        if self.exporter is not None:
+            self.exporter.close()
+            self.exporter = None
+        if self.coalescer is not None:
+            self.coalescer.flush()
+            self.coalescer = None
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+        if self.last_report is not None:
+            self.last_report.close()
+            self.last_report = None
+
+    def request(self, flow):
+        path = flow.request.path.partition('?')[0]
+        if path == '/+httpolice/':
+            if ctx.options.httpolice_live:
+                flow.response = self.serve_live_report(flow.request.query)
+            else:
+                flow.response = self.serve_report()
+        elif path == '/+httpolice/index':
+            self.serve_index(flow)
+        elif path == '/+httpolice/stats.json':
+            flow.response = make_response(
+                HTTPStatus.OK.value,
+                json.dumps(self.notice_stats.to_json(self.all_counters()),
+                           indent=2).encode('utf-8'),
+                'application/json')
+        elif path == '/+httpolice/metrics':
+            flow.response = make_response(
+                HTTPStatus.OK.value,
+                (self.notice_stats.to_prometheus(self.all_counters()) +
+                 self.stage_times.to_prometheus()).encode('utf-8'),
+                'text/plain; version=0.0.4; charset=utf-8')
+
+    def requestheaders(self, flow):
+        if self.wants_early():
+            self.check_headers(flow)
+
+    def responseheaders(self, flow):
+        if self.wants_early():
+            self.early[flow.id] = None
+            self.check_headers(flow)
+
+    def wants_early(self):
+        # When only some flows are to be checked, we don't know yet
+        # if this is one of them, so we don't check any early.
+        return ctx.options.httpolice_early and not self.sampler.active()
+
+    def error(self, flow):
+        self.early.pop(flow.id, None)
+
+    def check_headers(self, flow):
+        # A preliminary check on what has arrived so far. Bodies that haven't
+        # arrived yet are unknown to HTTPolice, so only the headers (and the
+        # request body, if we're at the response headers) are checked.
+        # This doesn't count for stats, marks, logs and so on:
+        # that happens in ``response``, when we know everything.
+        background = self.pool is not None
+        if background and self.pool.pending >= ctx.options.httpolice_queue:
+            if ctx.options.httpolice_queue_full == 'drop':
+                self.counters['early dropped'] += 1
+                return
+            background = False
+        exch = build_exchange(flow, self.policy.silence_for(flow))
+        if not background:
+            exch, result, _, _ = check_and_render(exch)
+            self.finish_headers(flow, exch, result)
+        else:
+            self.pool.submit(flow, self.finish_headers_background, exch)
+
+    def finish_headers_background(self, flow, future):
+        try:
+            exch, result, _, _ = future.result()
+        except Exception as exc:
+            self.counters['failed'] += 1
+            ctx.log.error(f'HTTPolice: failed to check flow: {exc!r}')
+            return
+        self.finish_headers(flow, exch, result)
+
+    def finish_headers(self, flow, exch, result):
+        if 'HTTPolice: stored' in flow.metadata:
+            # The whole flow has been checked already.
+            return
+        attach_report(result.lines, flow, preliminary=True)
+        if exch.responses and flow.id in self.early:
+            self.early[flow.id] = (exch, result)
+        if flow.response is not None:
+            # The request has been displayed already (unlike at
+            # ``requestheaders``), so refresh it with our notices.
+            ctx.master.addons.trigger('update', [flow])
+
+    def response(self, flow):
+        early = self.early.pop(flow.id, None)
+        if self.related.max_size:
+            self.check_related(flow)
+        result = stored_result(flow)
+        if result is not None:
+            # Probably loaded from a file where we saved it earlier.
+            self.counters['stored hits'] += 1
+            self.finish(flow, result)
+            self.index_flow(flow, result)
+            return
+        skip = self.sampler.skip(flow)
+        if skip:
+            self.counters[f'skipped ({skip})'] += 1
+            detach_report(flow)
+            return
+        silence = self.policy.silence_for(flow)
+        fingerprint = None
+        if self.fingerprints.max_size:
+            fingerprint = flow_fingerprint(flow, silence)
+            result = self.fingerprints.get(fingerprint)
+            if result is not None:
+                self.counters['fingerprint hits'] += 1
+                self.finish(flow, result)
+                store_result(result, flow)
+                self.index_flow(flow, result)
+                return
+            self.counters['fingerprint misses'] += 1
+        live = bool(ctx.options.httpolice_live)
+        if early is not None and flow.response.raw_content is None:
+            # The response was streamed, so there's nothing new to check
+            # since we checked its headers.
+            self.counters['early hits'] += 1
+            exch, result = early
+            piece = render_piece(httpolice.html_report, exch) if live else None
+            self.finish_checked(flow, exch, result, piece, None, fingerprint)
+            return
+        background = self.pool is not None
+        if background and self.pool.pending >= ctx.options.httpolice_queue:
+            if ctx.options.httpolice_queue_full == 'drop':
+                self.counters['dropped'] += 1
+                detach_report(flow)
+                return
+            self.counters['waited'] += 1
+            background = False
+        start = time.perf_counter()
+        exch = build_exchange(flow, silence)
+        times = {'build': time.perf_counter() - start}
+        if background:
+            self.counters['queued'] += 1
+            self.pool.submit(
+                flow,
+                lambda flow, future:
+                    self.finish_background(flow, future, times, fingerprint),
+                exch, live,
+            )
+        else:
+            exch, result, piece, check_times = check_and_render(exch, live)
+            times.update(check_times)
+            self.finish_checked(flow, exch, result, piece, times, fingerprint)
+
+    def check_related(self, flow):
+        problems = self.related.check(flow)
+        try:
+            flow.metadata.pop('HTTPolice: related', None)
+            if problems:
+                flow.metadata['HTTPolice: related'] = ReportLines.of(
+                    f'{severity.name[0].upper()} {text}'
+                    for (severity, text) in problems)
+        except Exception:
+            # `flow.metadata` is not public API,
+            # so could theoretically fail.
+            pass
+        if problems:
+            self.counters['related problems'] += len(problems)
+            mark_flow([(None, severity) for (severity, _) in problems],
+                      flow, self.policy)
+            if self.coalescer is not None:
+                self.coalescer.count(
+                    flow, 'problems across flows',
+                    max(severity for (severity, _) in problems))
+                return
+            ctx.log.warn('HTTPolice: {0} in: {1} {2} ← {3}'.format(
+                '; '.join(text for (_, text) in problems),
+                flow.request.method, ellipsize(flow.request.path),
+                flow.response.status_code,
+            ))
+
+    def update(self, flows):
+        # mitmproxy sends this after every event on a flow, not only
+        # when the user edits it, so only an edited flow (which mitmproxy
+        # backs up first) has anything stale on it.
+        for flow in flows:
+            if flow.modified():
+                self.cache.discard(flow)
+                flow.metadata.pop('HTTPolice: stored', None)
+
+    def finish(self, flow, result, times=None):
+        start = time.perf_counter()
+        attach_report(result.lines, flow)
+        mark_flow(result.notices, flow, self.policy)
+        if self.coalescer is not None:
+            self.coalescer.add(result.notices, flow)
+        else:
+            log_flow(result.notices, flow)
+        self.notice_stats.add(flow, result.notices)
+        if self.jsonl is not None or self.exporter is not None:
+            line = jsonl_line(flow, result.notices)
+            if self.jsonl is not None and not self.jsonl.write(line):
+                self.counters['jsonl dropped'] += 1
+            if self.exporter is not None and not self.exporter.write(line):
+                self.counters['export dropped'] += 1
+        if times is not None:
+            times['finish'] = time.perf_counter() - start
+            self.record_times(flow, times)
+
+    def finish_background(self, flow, future, times, fingerprint):
+        try:
+            exch, result, piece, check_times = future.result()
+        except Exception as exc:
+            self.counters['failed'] += 1
+            ctx.log.error(f'HTTPolice: failed to check flow: {exc!r}')
+            return
+        times.update(check_times)
+        self.finish_checked(flow, exch, result, piece, times, fingerprint,
+                            refresh=True)
+
+    def finish_checked(self, flow, exch, result, piece, times, fingerprint,
+                       refresh=False):
+        self.counters['checked'] += 1
+        self.finish(flow, result, times)
+        if piece is not None:
+            self.live_report.add(flow, result.notices, piece)
+        if refresh:
+            # The flow has probably been passed on and displayed by now,
+            # so tell mitmproxy to refresh it with our metadata and mark.
+            ctx.master.addons.trigger('update', [flow])
+        # Only after the update, which would otherwise discard these.
+        store_result(result, flow)
+        self.index_flow(flow, result)
+        self.cache.put(flow, exch)
+        if fingerprint is not None:
+            self.fingerprints.put(fingerprint, result)
+
+    def index_flow(self, flow, result):
+        # After `store_result`, so that the saved flow has its notices
+        # and is not checked again when loaded.
+        if self.index is not None and not self.index.add(flow, result.notices):
+            self.counters['index dropped'] += 1
+
+    def record_times(self, flow, times):
+        if ctx.options.httpolice_timing:
+            self.stage_times.add(times)
+        total = sum(times.values())
+        if ctx.options.httpolice_slow and \
+                total * 1000 > ctx.options.httpolice_slow:
+            self.counters['slow'] += 1
+            if self.coalescer is not None:
+                self.coalescer.count(
+                    flow, f'over {ctx.options.httpolice_slow} ms to check',
+                    httpolice.Severity.debug)
+                return
+            ctx.log.info('HTTPolice: {0:.1f} ms ({1}) on: {2} {3} ← {4}'.format(
+                total * 1000,
+                ', '.join(f'{stage} {seconds * 1000:.1f}'
+                          for (stage, seconds) in times.items()),
+                flow.request.method, ellipsize(flow.request.path),
+                flow.response.status_code,
+            ))
+
+    def checked_exchange(self, flow):
+        exch = self.cache.get(flow)
+        if exch is None:
+            self.counters['cache misses'] += 1
+            exch = flow_to_exchange(flow, self.policy.silence_for(flow))
+            self.cache.put(flow, exch)
+        else:
+            self.counters['cache hits'] += 1
+        return exch
+
+    def checked_notices(self, flow):
+        notices = stored_notices(flow)
+        if notices is not None:
+            self.counters['stored hits'] += 1
+            return notices
+        return exchange_notices(self.checked_exchange(flow))
+
+    def select(self, flows, background=False):
+        # Returns the flows to include in a report, and the exchanges
+        # for those of them that had to be checked here (by flow ID),
+        # so that the report doesn't check them again. Most flows have
+        # their notices stored, so they don't have to be checked again
+        # just to be left out. When `background`, flows that have to be
+        # checked are left for the worker processes to select.
+        if not self.selection:
+            return flows, {}
+        selected, checked = [], {}
+        for flow in flows:
+            if not self.selection.wants_flow(flow):
+                continue
+            exch = None
+            notices = stored_notices(flow)
+            if notices is not None:
+                self.counters['stored hits'] += 1
+            elif not background:
+                exch = self.checked_exchange(flow)
+                notices = exchange_notices(exch)
+            if notices is None or self.selection.wants_notices(notices):
+                selected.append(flow)
+                if exch is not None:
+                    checked[flow.id] = exch
+        return selected, checked
+
+    def all_counters(self):
+        counters = self.counters
+        if self.exporter is not None and self.exporter.lost:
+            # Counted in the exporter's thread, so kept separately.
+            counters = counters.copy()
+            counters['export lost'] += self.exporter.lost
+        if self.index is not None and self.index.unreadable:
+            counters = counters.copy()
+            counters['index unreadable'] += self.index.unreadable
+        return counters
+
+    @mitmproxy.command.command('httpolice.stats')
+    def stats(self) -> str:
+        """Show how many flows HTTPolice has checked, queued, dropped..."""
+        pending = 0 if self.pool is None else self.pool.pending
+        pieces = [f'{name}: {n}'
+                  for (name, n) in sorted(self.all_counters().items())]
+        pieces.append(f'pending: {pending}')
+        pieces.extend(self.stage_times.summary())
+        return ', '.join(pieces)
+
+    @mitmproxy.command.command('httpolice.report.html')
+    def html_report(self,
+                    flows: typing.Sequence[mitmproxy.flow.Flow],
+                    path: mitmproxy.types.Path) -> None:
+        """Produce an HTTPolice report (HTML) on flows."""
+        self.report(flows, 'html', path)
+
+    @mitmproxy.command.command('httpolice.report.text')
+    def text_report(self,
+                    flows: typing.Sequence[mitmproxy.flow.Flow],
+                    path: mitmproxy.types.Path) -> None:
+        """Produce an HTTPolice report (text) on flows."""
+        self.report(flows, 'text', path)
+
+    @mitmproxy.command.command('httpolice.report.jsonl')
+    def jsonl_report(self,
+                     flows: typing.Sequence[mitmproxy.flow.Flow],
+                     path: mitmproxy.types.Path) -> None:
+        """Produce an HTTPolice report (JSON Lines) on flows."""
+        self.report(flows, 'jsonl', path)
+
+    @mitmproxy.command.command('httpolice.index.report')
+    def index_report(self, format_: str, path: mitmproxy.types.Path) -> None:
+        """Produce an HTTPolice report (html, text or jsonl) on flows
+        in httpolice_index, selected by httpolice_report_* options."""
+        if self.index is None:
+            raise mitmproxy.exceptions.CommandError(
+                'HTTPolice: httpolice_index is not set')
+        if format_ not in list(report_formats) + ['jsonl']:
+            raise mitmproxy.exceptions.CommandError(
+                f'HTTPolice: unknown report format: {format_}')
+        rows = self.index.select(self.selection)
+        if ctx.options.httpolice_report_jobs > 0:
+            self.start_background_report(self.index.read(rows), len(rows),
+                                         format_, path)
+            return
+        out = open_report(path)
+        try:
+            write_index_report(self.index.read(rows), format_, self.policy,
+                               out)
+        except BaseException:
+            out.close()
+            raise
+        self.save_report(out, path, len(rows))
+
+    @mitmproxy.command.command('httpolice.report.cancel')
+    def cancel_report(self) -> None:
+        """Stop producing an HTTPolice report in the background."""
+        if self.background_report is None or self.background_report.done():
+            raise mitmproxy.exceptions.CommandError(
+                'HTTPolice: no report is in progress')
+        self.background_report.cancel()
+
+    def report(self, flows, format_, path):
+        if ctx.options.httpolice_report_jobs > 0:
+            # Flows may be added or removed while we're working,
+            # so stick to the ones selected now.
+            flows, _ = self.select(flows, background=True)
+            flows = list(flows)
+            self.start_background_report(flows, len(flows), format_, path)
+            return
+        flows, checked = self.select(flows)
+
+        def get_exchange(flow):
+            exch = checked.pop(flow.id, None)
+            return self.checked_exchange(flow) if exch is None else exch
+
+        def get_notices(flow):
+            exch = checked.get(flow.id)
+            return self.checked_notices(flow) if exch is None \
+                else exchange_notices(exch)
+
+        if format_ == 'jsonl':
+            report_func = functools.partial(write_jsonl, flows, get_notices)
+        else:
+            report_func = getattr(httpolice, report_formats[format_])
+        exchanges = (get_exchange(flow) for flow in flows)
+        out = open_report(path)
+        try:
+            report_func(exchanges, out)
+        except BaseException:
+            out.close()
+            raise
+        self.save_report(out, path, len(flows))
+
+    def start_background_report(self, flows, count, format_, path):
+        # `flows` may be a generator, like from `ResultIndex.read`,
+        # so `count` is how many there are.
+        if self.background_report is not None and \
+                not self.background_report.done():
+            raise mitmproxy.exceptions.CommandError(
+                'HTTPolice: another report is in progress '
+                '(see httpolice.report.cancel)')
+        out = open_report(path)
+        self.background_report = asyncio.ensure_future(
+            self.run_background_report(flows, count, format_, path, out))
+        ctx.log.alert(f'HTTPolice: producing report on {count} flows '
+                      f'in the background')
+
+    async def run_background_report(self, flows, count, format_, path, out):
+        try:
+            reported = await render_in_processes(
+                flows, count, format_, out,
+                ctx.options.httpolice_report_jobs, option_values())
+        except BaseException as exc:
+            out.close()
+            if path != '-':
+                os.remove(path)
+            if isinstance(exc, asyncio.CancelledError):
+                ctx.log.alert('HTTPolice: report cancelled')
+                raise
+            ctx.log.error(f'HTTPolice: failed to produce report: {exc!r}')
+            return
+        self.save_report(out, path, reported)
+
+    def save_report(self, out, path, count):
+        if path == '-':
+            if self.last_report is not None:
+                self.last_report.close()
+            self.last_report = out
+            ctx.log.alert(f'HTTPolice: saved report on {count} flows in memory')
+        else:
+            out.close()
+            ctx.log.alert(f'HTTPolice: wrote report on {count} flows to {path}')
+
+    def serve_report(self):
+        if self.last_report is None:
+            status_code = HTTPStatus.NOT_FOUND.value
+            content = (
+                f'<!DOCTYPE html><p>No report has been <a href="'
+                f'https://mitmproxy-httpolice.readthedocs.io/en/{__version__}/'
+                f'walkthrough.html#inmemory">produced</a> yet.</p>'
+            ).encode('utf-8')
+        else:
+            status_code = HTTPStatus.OK.value
+            # mitmproxy can only send a response produced by an addon
+            # as a whole, so we can't stream it from the file here.
+            # But at least we only hold the entire report while serving it.
+            self.last_report.seek(0)
+            content = self.last_report.read()
+        return make_response(
+            status_code, content,
+            'text/html; charset=utf-8' if content.startswith(b'<!')
+            else 'text/plain; charset=utf-8'
+        )
+
+    def serve_index(self, flow):
+        # Reading and checking the flows can take a while, so it's done
+        # in a thread, and the request waits for it like an intercepted one.
+        query = flow.request.query
+        if self.index is None:
+            flow.response = make_response(
+                HTTPStatus.NOT_FOUND.value,
+                b'httpolice_index is not set', 'text/plain; charset=utf-8')
+            return
+        try:
+            selection = Selection(query.get('severity', ''),
+                                  query.get_all('id'),
+                                  [query['host']] if 'host' in query else [])
+            limit = int(query.get('limit', 100))
+            if limit < 1:
+                raise ValueError('limit must be positive')
+        except ValueError as exc:
+            flow.response = make_response(HTTPStatus.BAD_REQUEST.value,
+                                          str(exc).encode('utf-8'),
+                                          'text/plain; charset=utf-8')
+            return
+        limit = min(limit, self.max_index_limit)
+        flow.reply.take()
+        future = asyncio.get_event_loop().run_in_executor(
+            None, render_index, self.index, selection, limit, self.policy)
+        future.add_done_callback(functools.partial(self.index_served, flow))
+
+    @staticmethod
+    def index_served(flow, future):
+        try:
+            flow.response = make_response(HTTPStatus.OK.value,
+                                          future.result(),
+                                          'text/html; charset=utf-8')
+        except Exception as exc:
+            flow.response = make_response(
+                HTTPStatus.INTERNAL_SERVER_ERROR.value,
+                f'HTTPolice: failed to read index: {exc!r}'.encode('utf-8'),
+                'text/plain; charset=utf-8')
+        flow.reply.ack()
+        flow.reply.commit()
+
+    def serve_live_report(self, query):
+        min_severity = query.get('severity')
+        if min_severity is not None:
+            try:
+                min_severity = httpolice.Severity[min_severity]
+            except KeyError:
+                return make_response(
+                    HTTPStatus.BAD_REQUEST.value,
+                    b'Unknown severity, must be one of: ' +
+                    ', '.join(sev.name for sev in httpolice.Severity).
+                    encode('ascii'),
+                    'text/plain; charset=utf-8')
+        content = self.live_report.render(min_severity, query.get('host'))
+        return make_response(HTTPStatus.OK.value, content,
+                             'text/html; charset=utf-8')
+
+
+def open_report(path):
+    if path == '-':
+        # HTTPolice writes the report exchange by exchange, so it only
+        # has to fit in memory if it's small enough. Bigger reports
+        # spill over to disk.
+        return tempfile.SpooledTemporaryFile(
+            max_size=ctx.options.httpolice_report_memory)
+    return open(path, 'wb')
+
+
+async def render_in_processes(flows, count, format_, out, jobs, options,
+                              progress_interval=5):
+    # Like `check_files`, but for flows in mitmproxy, without blocking
+    # the event loop. The flows are serialized here, a few per worker
+    # at a time, and the pieces of the report are written as they come back,
+    # in order. Cancelling this also cancels the flows not yet checked.
+    # Returns the number of flows in the report, which is less than `count`
+    # if the workers have left some out (see `check_flow`).
+    #
+    # The workers are spawned rather than forked, because mitmproxy
+    # (and we) have threads running that a forked copy would not.
+    # And they can't see the module mitmproxy loaded this script as,
+    # so they get the same code under its real name (see `importable_self`).
+    with importable_self() as module:
+        pool = multiprocessing.get_context('spawn').Pool(jobs)
+    futures = collections.deque()
+    written = reported = 0
+    last_progress = time.monotonic()
+
+    async def write_next():
+        nonlocal written, reported, last_progress
+        piece = await futures.popleft()
+        out.write(piece)
+        written += 1
+        if piece:
+            reported += 1
+        if time.monotonic() - last_progress > progress_interval:
+            last_progress = time.monotonic()
+            ctx.log.alert(
+                f'HTTPolice: report on {written} of {count} flows done')
+
+    if format_ == 'jsonl':
+        prologue, epilogue = b'', b''
+    else:
+        prologue, epilogue = report_frame(
+            getattr(httpolice, report_formats[format_]))
+    try:
+        out.write(prologue)
+        for flow in flows:
+            futures.append(apply_in_pool(
+                pool, module.check_flow_state, dump_flow(flow), format_,
+                (), options))
+            if len(futures) >= jobs * 4:
+                await write_next()
+        while futures:
+            await write_next()
+        out.write(epilogue)
+    finally:
+        for future in futures:
+            future.cancel()
+        pool.terminate()
+    return reported
+
+
+@contextlib.contextmanager
+def importable_self():
+    # mitmproxy loads this script as ``__mitmproxy_script__.<name>``,
+    # which no other process can import, so our functions can't be pickled
+    # by reference. Import this file again as ``mitmproxy_httpolice``,
+    # with its directory on `sys.path` for as long as it takes
+    # to spawn the workers, which inherit the path.
+    if __name__ == 'mitmproxy_httpolice':
+        yield sys.modules[__name__]
+        return
+    saved_path = sys.path[:]
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    try:
+        yield importlib.import_module('mitmproxy_httpolice')
+    finally:
+        sys.path[:] = saved_path
+
+
+def apply_in_pool(pool, func, *args):
+    # Like `loop.run_in_executor`, but for a `multiprocessing` pool.
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+
+    def resolve(result, exc=None):
+        if future.done():               # cancelled
+            return
+        if exc is None:
+            future.set_result(result)
+        else:
+            future.set_exception(exc)
+
+    pool.apply_async(
+        func, args,
+        callback=lambda result: loop.call_soon_threadsafe(resolve, result),
+        error_callback=lambda exc: loop.call_soon_threadsafe(resolve,
+                                                             None, exc))
+    return future
+
+
+def option_values():
+    # The options that affect checking and selection, to be set up
+    # in worker processes with `setup_headless`. Others, like
+    # ``httpolice_jsonl``, would have the workers do things
+    # that only the addon should do.
+    return {name: getattr(ctx.options, name)
+            for name in ['httpolice_silence', 'httpolice_silence_rules',
+                         'httpolice_max_body', 'httpolice_body_types',
+                         'httpolice_report_severity', 'httpolice_report_ids',
+                         'httpolice_report_hosts']}
+
+
+def warm_up():
+    # Import HTTPolice and get it through its first check,
+    # so that the first flow doesn't have to wait for that.
+    # If this fails, it will fail again on the first flow, and be logged
+    # there (logging from this thread wouldn't be safe).
+    try:
+        report_frame(httpolice.html_report)
+    except Exception:
+        pass
+
+
+def make_response(status_code, content, content_type):
+    headers = {
+        'Date': email.utils.formatdate(usegmt=True),
+        'Content-Type': content_type,
+        'Cache-Control': 'no-store',
+    }
+    return mitmproxy.http.HTTPResponse.wrap(
+        mitmproxy.net.http.Response.make(status_code, content, headers),
+    )
+
+
+class NoticeStats:
+
+    """Running totals of notices on all checked flows.
+
+    These are counted by notice ID, and by severity per host
+    and per status code. Updating them costs O(1) per notice.
+
+    Only a bounded number of hosts are counted on their own.
+    When there are more, the least recently seen host's counts
+    are added to those for `other_host`.
+
+    """
+
+    max_hosts = 1000
+    other_host = '(other)'
+
+    def __init__(self):
+        self.flows = 0
+        self.by_notice = collections.Counter()
+        self.by_host = collections.Counter()
+        self.by_status = collections.Counter()
+        self.hosts = collections.OrderedDict()
+
+    def add(self, flow, notices):
+        self.flows += 1
+        host = self.seen_host(flow.request.host) if notices else None
+        status = flow.response.status_code if flow.response else None
+        for (id_, severity) in notices:
+            self.by_notice[(id_, severity.name)] += 1
+            self.by_host[(host, severity.name)] += 1
+            self.by_status[(status, severity.name)] += 1
+
+    def seen_host(self, host):
+        if host in self.hosts:
+            self.hosts.move_to_end(host)
+            return host
+        self.hosts[host] = None
+        if len(self.hosts) > self.max_hosts:
+            old_host, _ = self.hosts.popitem(last=False)
+            for severity in httpolice.Severity:
+                n = self.by_host.pop((old_host, severity.name), 0)
+                if n:
+                    self.by_host[(self.other_host, severity.name)] += n
+        return host
+
+    def to_json(self, counters):
+        return {
+            'flows': self.flows,
+            'notices': {
+                str(id_): {'severity': severity, 'count': n}
+                for ((id_, severity), n) in sorted(self.by_notice.items())
+            },
+            'hosts': nest(self.by_host),
+            'statuses': nest(self.by_status),
+            'counters': dict(counters),
+        }
+
+    def to_prometheus(self, counters):
+        # https://prometheus.io/docs/instrumenting/exposition_formats/
+        lines = [
+            '# TYPE httpolice_flows_total counter',
+            f'httpolice_flows_total {self.flows}',
+        ]
+        for (name, key, table) in [
+                ('notices', ('id', 'severity'), self.by_notice),
+                ('host_notices', ('host', 'severity'), self.by_host),
+                ('status_notices', ('status', 'severity'), self.by_status),
+                ('events', ('event',),
+                 {(event,): n for (event, n) in counters.items()}),
+        ]:
+            lines.append(f'# TYPE httpolice_{name}_total counter')
+            for (values, n) in sorted(table.items(), key=str):
+                labels = ','.join(f'{label}="{prometheus_escape(value)}"'
+                                  for (label, value) in zip(key, values))
+                lines.append(f'httpolice_{name}_total{{{labels}}} {n}')
+        return '\n'.join(lines) + '\n'
+
+
+def nest(counter):
+    # ``{(a, b): n}`` -> ``{a: {b: n}}``, with `a` as a string for JSON.
+    nested = collections.defaultdict(dict)
+    for ((outer, inner), n) in counter.items():
+        nested[str(outer)][inner] = n
+    return dict(nested)
+
+
+def prometheus_escape(value):
+    return (str(value).replace('\\', '\\\\').replace('\n', '\\n').
+            replace('"', '\\"'))
+
+
+class CheckPool:
+
+    """Checks exchanges in background threads.
+
+    Flows are converted to exchanges in the main thread, because they may
+    change after mitmproxy passes them on. The actual checking and rendering
+    of notices, which is the expensive part, happens in a worker thread.
+    The results are then handed back to the main thread (the event loop),
+    where it is safe to touch the flow again.
+
+    """
+
+    def __init__(self, workers):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='HTTPolice')
+        self.pending = 0
+
+    def submit(self, flow, callback, *args):
+        loop = asyncio.get_event_loop()
+        future = self.executor.submit(check_and_render, *args)
+        self.pending += 1
+
+        def done(future):
+            loop.call_soon_threadsafe(self.on_done, flow, future, callback)
+
+        future.add_done_callback(done)
+
+    def on_done(self, flow, future, callback):
+        self.pending -= 1
+        callback(flow, future)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+class ResultCache:
+
+    """Remembers checked exchanges by flow ID, least recently used first out.
+
+    The size of an entry is approximated by the size of its messages'
+    headers and raw bodies. HTTPolice also keeps decoded bodies
+    (and, for JSON and XML, parsed ones) on the exchange, which may take
+    several times as much, but we can't measure those through its API.
+
+    """
+
+    def __init__(self, max_size=0):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = collections.OrderedDict()
+
+    def get(self, flow):
+        entry = self.entries.get(flow.id)
+        if entry is None:
+            return None
+        version, exch, _ = entry
+        if version != flow_version(flow):
+            self.discard(flow)
+            return None
+        self.entries.move_to_end(flow.id)
+        return exch
+
+    def put(self, flow, exch):
+        self.discard(flow)
+        size = flow_size(flow)
+        if size > self.max_size:
+            return
+        self.entries[flow.id] = (flow_version(flow), exch, size)
+        self.size += size
+        self.trim()
+
+    def discard(self, flow):
+        entry = self.entries.pop(flow.id, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def resize(self, max_size):
+        self.max_size = max_size
+        self.trim()
+
+    def trim(self):
+        while self.size > self.max_size:
+            _, (_, _, size) = self.entries.popitem(last=False)
+            self.size -= size
+
+
+class Sampler:
+
+    """Decides which flows to skip when there are too many to check.
+
+    Per-endpoint state is kept for a bounded number of endpoints,
+    forgetting the least recently seen ones.
+
+    """
+
+    max_endpoints = 10000
+
+    def __init__(self):
+        self.buckets = collections.OrderedDict()
+        self.seen = collections.OrderedDict()
+
+    @staticmethod
+    def active():
+        return ctx.options.httpolice_sample < 100 or \
+            bool(ctx.options.httpolice_first) or \
+            bool(ctx.options.httpolice_rate)
+
+    def skip(self, flow):
+        # Returns the reason for skipping `flow`, or `None` to check it.
+        if random.randrange(100) >= ctx.options.httpolice_sample:
+            return 'sample'
+        signature = None
+        if ctx.options.httpolice_first:
+            signature = (flow.request.method, flow.request.host,
+                         path_template(flow.request.path),
+                         flow.response.status_code)
+            if self.seen.get(signature, 0) >= ctx.options.httpolice_first:
+                self.seen.move_to_end(signature)
+                return 'first'
+        if ctx.options.httpolice_rate and not self.take_token(flow):
+            return 'rate'
+        if signature is not None:
+            self.count(self.seen, signature)
+        return None
+
+    def take_token(self, flow):
+        # Token bucket that holds up to one second's worth of flows.
+        rate = ctx.options.httpolice_rate
+        key = (flow.request.host, path_template(flow.request.path))
+        now = time.monotonic()
+        tokens, last = self.buckets.pop(key, (rate, now))
+        tokens = min(rate, tokens + (now - last) * rate)
+        ok = tokens >= 1
+        self.remember(self.buckets, key, (tokens - 1 if ok else tokens, now))
+        return ok
+
+    def count(self, table, key):
+        self.remember(table, key, table.pop(key, 0) + 1)
+
+    def remember(self, table, key, value):
+        table[key] = value
+        if len(table) > self.max_endpoints:
+            table.popitem(last=False)
+
+
+def path_template(path):
+    """Strip the query from `path` and replace IDs in it with ``*``.
+
+    >>> path_template('/api/users/123/posts/?page=2')
+    '/api/users/*/posts/'
+
+    """
+    path = path.partition('?')[0]
+    return _id_segment_re.sub('/*', path)
+
+
+# Path segments that look like numbers, UUIDs or long hex hashes.
+_id_segment_re = re.compile(
+    r'/(?:[0-9]+|[0-9a-fA-F]{8}-(?:[0-9a-fA-F]{4}-){3}[0-9a-fA-F]{12}|'
+    r'[0-9a-fA-F]{16,})(?=/|$)'
+)
+
+
+def flow_version(flow):
+    # Replaying a flow replaces its messages, with new timestamps.
+    # In-place edits are handled by the ``update`` event instead.
+    return (flow.request.timestamp_start,
+            flow.response.timestamp_end if flow.response else None)
+
+
+def flow_size(flow):
+    return sum(len(msg.raw_content or b'') +
+               sum(len(k) + len(v) for (k, v) in msg.headers.fields)
+               for msg in [flow.request, flow.response] if msg is not None)
+
+
+class FingerprintCache:
+
+    """Remembers results by flow fingerprint, least recently used first out."""
+
+    def __init__(self, max_size=0):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+
+    def get(self, fingerprint):
+        result = self.entries.get(fingerprint)
+        if result is not None:
+            self.entries.move_to_end(fingerprint)
+        return result
+
+    def put(self, fingerprint, result):
+        self.entries[fingerprint] = result
+        self.entries.move_to_end(fingerprint)
+        self.trim()
+
+    def clear(self):
+        self.entries.clear()
+
+    def resize(self, max_size):
+        self.max_size = max_size
+        self.trim()
+
+    def trim(self):
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+# Headers whose values are left out of `flow_fingerprint`. ``Expires``
+# and ``Last-Modified`` are not among them, because HTTPolice checks
+# their values (for example, for a ``Last-Modified`` in the future).
+volatile_headers = frozenset([
+    b'age', b'cookie', b'date', b'set-cookie', b'x-request-id',
+])
+
+
+def flow_fingerprint(flow, silence):
+    # Flows with equal fingerprints are assumed to get the same notices.
+    hasher = hashlib.sha1()
+    # Different flows with the same path template may be silenced differently
+    # (see `Policy.silence_for`).
+    hasher.update(b'%r\0' % sorted(silence))
+    for piece in [flow.request.method, flow.request.scheme,
+                  flow.request.host, flow.request.http_version,
+                  path_template(flow.request.path)]:
+        hasher.update(encode(piece) + b'\0')
+    for msg in [flow.request, flow.response]:
+        hasher.update(b'%d\0' % getattr(msg, 'status_code', 0))
+        for (name, value) in msg.headers.fields:
+            hasher.update(name + b'\0')
+            if name.lower() not in volatile_headers:
+                hasher.update(value)
+            hasher.update(b'\0')
+        reason = why_unchecked(msg)
+        if reason:
+            hasher.update(encode(reason))
+        else:
+            hasher.update(hashlib.sha1(msg.raw_content).digest())
+        hasher.update(b'\0')
+    return hasher.digest()
+
+
+class RelatedFlows:
+
+    """Finds problems that only show up when looking at several flows.
+
+    HTTPolice checks every exchange on its own. Here we remember
+    the latest 200 (OK) response to GET for a bounded number of resources,
+    least recently seen first out, and compare each new flow to the one
+    for the same resource. This is a couple of dictionary lookups per flow,
+    no matter how many flows there are.
+
+    """
+
+    def __init__(self, max_size=0):
+        self.max_size = max_size
+        self.latest = collections.OrderedDict()
+
+    def check(self, flow):
+        # Returns a list of ``(severity, text)``.
+        resp = flow.response
+        method = flow.request.method
+        if resp is None or method not in ['GET', 'HEAD']:
+            return []
+        key = (flow.request.host, flow.request.port, flow.request.path)
+        earlier = self.latest.get(key)
+        # A 200 (OK) to HEAD has no body to compare digests of.
+        now = Validators.of(flow) \
+            if resp.status_code == 200 and method == 'GET' else None
+        problems = []
+        if earlier is not None:
+            self.latest.move_to_end(key)
+            if now is not None:
+                problems.extend(self.compare_ok(now, earlier))
+            elif resp.status_code == 304:
+                problems.extend(self.compare_not_modified(flow, earlier))
+        if now is not None:
+            self.latest[key] = now
+            self.trim()
+        return problems
+
+    @staticmethod
+    def compare_ok(now, earlier):
+        # RFC 7232 Section 2.1: a strong validator changes
+        # whenever the representation data changes.
+        if now.etag is not None and now.etag == earlier.etag and \
+                None not in [now.digest, earlier.digest] and \
+                now.encoding == earlier.encoding and \
+                now.digest != earlier.digest:
+            yield (httpolice.Severity.error,
+                   f'Strong ETag {now.etag} was already sent with '
+                   f'a different body (flow {earlier.flow_id})')
+
+    @staticmethod
+    def compare_not_modified(flow, earlier):
+        # The server says that the client's copy is still good,
+        # but it has just sent a newer one. Unless it varies
+        # on something else, it's probably wrong.
+        if earlier.vary:
+            return
+        headers = flow.request.headers
+        if 'If-None-Match' in headers:
+            tags = [tag.strip() for tag in
+                    decode(headers['If-None-Match']).split(',')]
+            if earlier.etag is not None and \
+                    not any(weak_match(tag, earlier.etag) for tag in tags):
+                yield (httpolice.Severity.comment,
+                       f'304 (Not Modified) for {", ".join(tags)}, '
+                       f'but the latest 200 (OK) had ETag {earlier.etag} '
+                       f'(flow {earlier.flow_id})')
+        elif 'If-Modified-Since' in headers:
+            since = parse_date(headers['If-Modified-Since'])
+            if None not in [since, earlier.last_modified] and \
+                    earlier.last_modified > since:
+                yield (httpolice.Severity.comment,
+                       f'304 (Not Modified) for If-Modified-Since, '
+                       f'but the latest 200 (OK) was modified later '
+                       f'(flow {earlier.flow_id})')
+
+    def resize(self, max_size):
+        self.max_size = max_size
+        self.trim()
+
+    def trim(self):
+        while len(self.latest) > self.max_size:
+            self.latest.popitem(last=False)
+
+
+class Validators(typing.NamedTuple):
+
+    """What `RelatedFlows` remembers about a 200 (OK) response to GET."""
+
+    flow_id: str
+    etag: typing.Optional[str]
+    last_modified: typing.Optional[float]
+    digest: typing.Optional[bytes]
+    encoding: str
+    vary: bool
+
+    @classmethod
+    def of(cls, flow):
+        # Returns `None` for a response without validators,
+        # which is not worth remembering.
+        headers = flow.response.headers
+        etag = headers.get('ETag')
+        last_modified = parse_date(headers.get('Last-Modified'))
+        if etag is None and last_modified is None:
+            return None
+        etag = None if etag is None else decode(etag).strip()
+        digest = None
+        if etag is not None and not etag.startswith('W/') and \
+                flow.response.raw_content is not None:
+            digest = hashlib.sha1(flow.response.raw_content).digest()
+        return cls(flow.id, etag, last_modified, digest,
+                   decode(headers.get('Content-Encoding', '')).lower(),
+                   'Vary' in headers)
+
+
+def weak_match(tag1, tag2):
+    # RFC 7232 Section 2.3.2.
+    return tag1 == '*' or opaque_tag(tag1) == opaque_tag(tag2)
+
+
+def opaque_tag(tag):
+    return tag[2:] if tag.startswith('W/') else tag
+
+
+def parse_date(value):
+    if value is None:
+        return None
+    try:
+        return email.utils.parsedate_to_datetime(decode(value)).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+Result = collections.namedtuple('Result', ['lines', 'notices'])
+Result.__doc__ = """What we attach to a flow after checking it.
+
+``lines`` is a pair of `ReportLines` (see `report_lines`).
+``notices`` is a tuple of ``(id, severity)`` for every notice
+on the request and the responses.
+
+Many flows get the same notices, so these are shared between flows
+where possible (see `ReportLines.of` and `notice_pair`).
+"""
+
+
+def summarize(exch):
+    for_request, for_response = report_lines(exch)
+    return Result((ReportLines.of(for_request), ReportLines.of(for_response)),
+                  exchange_notices(exch))
+
+
+def exchange_notices(exch):
+    return tuple(notice_pair(notice.id, notice.severity)
+                 for msg in [exch.request] + exch.responses
+                 for notice in msg.notices)
+
+
+@functools.lru_cache(maxsize=None)
+def notice_pair(id_, severity):
+    # There are only so many notices, so this cache stays small.
+    return (id_, severity)
+
+
+def write_jsonl(flows, get_notices, exchanges, buf):
+    # Like `httpolice.text_report`, but one JSON record per flow.
+    # `exchanges` are not needed: the notices are taken from `get_notices`,
+    # which doesn't have to check a flow again if it has a stored result.
+    del exchanges
+    for flow in flows:
+        buf.write(jsonl_line(flow, get_notices(flow)))
+
+
+def jsonl_line(flow, notices):
+    record = {
+        'flow': flow.id,
+        'timestamp': flow.request.timestamp_start,
+        'method': flow.request.method,
+        'host': flow.request.host,
+        'target': flow.request.path,
+        'status': flow.response.status_code if flow.response else None,
+        'notices': [{'id': id_, 'severity': severity.name}
+                    for (id_, severity) in notices],
+    }
+    return (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+
+
+def store_result(result, flow):
+    # Save the notices along with the flow, so that when it's loaded
+    # from a file, we can reuse them instead of checking it again.
+    # The text of the notices is already saved under our other keys.
+    # mitmproxy 4 only allows simple values, such as strings, in metadata,
+    # so this is a JSON array of a digest of the settings, the flow's
+    # version, and a flat list of notice IDs and severity values.
+    # It stays in memory for every flow, so it's kept small.
+    stored = StoredResult(json.dumps([
+        stored_settings(),
+        list(flow_version(flow)),
+        [n for (id_, severity) in result.notices
+         for n in (id_, severity.value)],
+    ], separators=(',', ':')))
+    try:
+        flow.metadata['HTTPolice: stored'] = stored
+    except Exception:
+        # `flow.metadata` is not public API,
+        # so could theoretically fail.
+        pass
+
+
+def stored_result(flow):
+    # Returns a `Result` saved by `store_result`, or `None` if there's none
+    # or if it's stale (checked with another HTTPolice or other options).
+    notices = stored_notices(flow)
+    if notices is None:
+        return None
+    try:
+        lines = tuple(ReportLines.of(flow.metadata.get(title) or [])
+                      for title in ['HTTPolice: request',
+                                    'HTTPolice: response'])
+    except Exception:
+        return None
+    return Result(lines, notices)
+
+
+def stored_notices(flow):
+    # Like `stored_result`, but only the notices, which is cheaper.
+    try:
+        stored = flow.metadata.get('HTTPolice: stored')
+        if not isinstance(stored, str):
+            return None
+        settings, version, flat = json.loads(stored)
+        if settings != stored_settings() or \
+                version != list(flow_version(flow)):
+            return None
+        return tuple(notice_pair(id_, httpolice.Severity(severity))
+                     for (id_, severity) in zip(flat[::2], flat[1::2]))
+    except Exception:
+        return None
+
+
+def stored_settings():
+    # Everything that a stored result depends on, besides the flow itself
+    # (edits to which are handled by the ``update`` event).
+    return shared_settings(tuple(ctx.options.httpolice_silence),
+                           tuple(ctx.options.httpolice_silence_rules),
+                           ctx.options.httpolice_max_body,
+                           tuple(ctx.options.httpolice_body_types))
+
+
+@functools.lru_cache(maxsize=1)
+def shared_settings(silence, silence_rules, max_body, body_types):
+    # A short digest, so as not to repeat all of this in every flow.
+    # Cached because it's needed for every flow.
+    settings = {
+        'httpolice': httpolice.__version__,
+        'silence': sorted(int(id_) for id_ in silence),
+        'silence_rules': list(silence_rules),
+        'max_body': max_body,
+        'body_types': list(body_types),
+    }
+    return hashlib.sha1(
+        json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+class LineWriter:
+
+    """Appends lines to a file in a background thread.
+
+    Lines that don't fit into the queue are dropped, so that a slow disk
+    never holds up the proxy.
+
+    """
+
+    def __init__(self, path, max_pending=10000):
+        self.file = open(path, 'ab')
+        self.queue = queue.Queue(max_pending)
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name='HTTPolice writer')
+        self.thread.start()
+
+    def write(self, line):
+        try:
+            self.queue.put_nowait(line)
+        except queue.Full:
+            return False
+        return True
+
+    def run(self):
+        while True:
+            line = self.queue.get()
+            if line is None:
+                break
+            self.file.write(line)
+            if self.queue.empty():
+                self.file.flush()
+        self.file.close()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class ResultIndex:
+
+    """An on-disk index of checked flows, for very long sessions.
+
+    Every checked flow is appended to a flow file next to the index
+    (``<path>.flows``, which mitmproxy can also load), and its notices
+    are recorded in an SQLite database at `path`, along with the flow's
+    position in that file. Reports can then select flows in the database
+    and read just those from the file, so they don't have to be kept
+    in mitmproxy. Both files are written in a background thread;
+    like with `LineWriter`, flows that don't fit into the queue are dropped.
+
+    """
+
+    def __init__(self, path, max_pending=1000):
+        self.path = path
+        self.flows_path = path + '.flows'
+        # Fail here, rather than in the thread, if we can't open these.
+        connect_index(path).close()
+        open(self.flows_path, 'ab').close()
+        self.queue = queue.Queue(max_pending)
+        self.unreadable = 0
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name='HTTPolice index')
+        self.thread.start()
+
+    def add(self, flow, notices):
+        # The state is taken now, because the flow may change later.
+        resp = flow.response
+        row = (flow.id, json.dumps(flow_version(flow)),
+               flow.request.timestamp_start, flow.request.method,
+               flow.request.host, flow.request.path,
+               resp.status_code if resp else None,
+               max((severity.value for (_, severity) in notices),
+                   default=None))
+        notices = [(flow.id, id_, severity.value)
+                   for (id_, severity) in notices]
+        try:
+            state = flow.get_state()
+        except Exception:
+            # Something in the flow that mitmproxy can't save, such as
+            # metadata from another addon. Such a flow can't be in a file.
+            return False
+        try:
+            self.queue.put_nowait((state, row, notices))
+        except queue.Full:
+            return False
+        return True
+
+    def run(self):
+        db = connect_index(self.path)
+        with open(self.flows_path, 'ab') as f:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                self.write(db, f, *item)
+                if self.queue.empty():
+                    # The flows must be on disk before their rows are.
+                    f.flush()
+                    db.commit()
+        db.commit()
+        db.close()
+
+    @staticmethod
+    def write(db, f, state, row, notices):
+        # A flow that was loaded from a file we wrote ourselves
+        # doesn't need to be written again.
+        if db.execute('SELECT 1 FROM flows WHERE id = ? AND version = ?',
+                      row[:2]).fetchone():
+            return
+        position = f.tell()
+        mitmproxy.io.tnetstring.dump(state, f)
+        db.execute('DELETE FROM notices WHERE flow = ?', row[:1])
+        db.execute('INSERT OR REPLACE INTO flows '
+                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', row + (position,))
+        db.executemany('INSERT INTO notices VALUES (?, ?, ?)', notices)
+
+    def select(self, selection, limit=None):
+        # Returns ``(position, host, target)`` for flows that `selection`
+        # wants, oldest first. With `limit`, only the most recent ones.
+        # Severities and IDs are matched by SQLite; hosts and paths,
+        # which are patterns, are matched here.
+        conditions, params = [], []
+        if selection.ids:
+            conditions.append(
+                'EXISTS (SELECT 1 FROM notices WHERE flow = flows.id '
+                'AND notices.id IN (%s)%s)' % (
+                    ', '.join('?' * len(selection.ids)),
+                    '' if selection.min_severity is None
+                    else ' AND notices.severity >= ?'))
+            params.extend(sorted(selection.ids))
+            if selection.min_severity is not None:
+                params.append(selection.min_severity.value)
+        elif selection.min_severity is not None:
+            conditions.append('severity >= ?')
+            params.append(selection.min_severity.value)
+        query = 'SELECT position, host, target FROM flows'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY timestamp DESC'
+        db = connect_index(self.path)
+        try:
+            rows = []
+            for row in db.execute(query, params):
+                if selection.wants_target(row[1], row[2]):
+                    rows.append(row)
+                    if limit is not None and len(rows) >= limit:
+                        break
+        finally:
+            db.close()
+        rows.reverse()
+        return rows
+
+    def read(self, rows):
+        # Yields flows at the positions in `rows`. Flows that can't be read
+        # (say, the file was truncated) are skipped, and counted in
+        # `unreadable`. This may run in another thread, so it doesn't log.
+        with open(self.flows_path, 'rb') as f:
+            for (position, _, _) in rows:
+                f.seek(position)
+                try:
+                    for flow in mitmproxy.io.FlowReader(f).stream():
+                        yield flow
+                        break
+                    else:
+                        self.unreadable += 1
+                except mitmproxy.exceptions.FlowReadException:
+                    self.unreadable += 1
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+def connect_index(path):
+    db = sqlite3.connect(path)
+    # So that reports can read while the thread is writing.
+    db.execute('PRAGMA journal_mode = WAL')
+    db.executescript('''
+        CREATE TABLE IF NOT EXISTS flows (
+            id TEXT PRIMARY KEY, version TEXT, timestamp REAL,
+            method TEXT, host TEXT, target TEXT, status INTEGER,
+            severity INTEGER, position INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS flows_timestamp ON flows (timestamp);
+        CREATE INDEX IF NOT EXISTS flows_severity
+            ON flows (severity, timestamp);
+        CREATE TABLE IF NOT EXISTS notices (
+            flow TEXT, id INTEGER, severity INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS notices_flow ON notices (flow);
+        CREATE INDEX IF NOT EXISTS notices_id ON notices (id, severity);
+    ''')
+    return db
+
+
+def render_index(index, selection, limit, policy):
+    buf = io.BytesIO()
+    write_index_report(index.read(index.select(selection, limit)),
+                       'html', policy, buf)
+    return buf.getvalue()
+
+
+def write_index_report(flows, format_, policy, out):
+    if format_ == 'jsonl':
+        prologue, epilogue = b'', b''
+    else:
+        prologue, epilogue = report_frame(
+            getattr(httpolice, report_formats[format_]))
+    out.write(prologue)
+    for flow in flows:
+        out.write(check_flow(flow, format_, policy))
+    out.write(epilogue)
+
+
+class BatchExporter:
+
+    """Sends lines to a `StreamSink` or `SpoolSink` in a background thread.
+
+    Lines are sent in batches, when there are `batch_size` of them or
+    when the oldest is `interval` seconds old. Like with `LineWriter`,
+    lines that don't fit into the queue are dropped, so a slow collector
+    never holds up the proxy. Batches that can't be sent are lost
+    (and counted in `lost`); the next batch tries to reconnect.
+
+    """
+
+    def __init__(self, sink, batch_size=100, interval=1.0,
+                 max_pending=10000):
+        self.sink = sink
+        self.batch_size = max(batch_size, 1)
+        self.interval = interval
+        self.lost = 0
+        self.queue = queue.Queue(max_pending)
+        self.closing = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name='HTTPolice exporter')
+        self.thread.start()
+
+    def write(self, line):
+        try:
+            self.queue.put_nowait(line)
+        except queue.Full:
+            return False
+        return True
+
+    def run(self):
+        batch = []
+        deadline = None
+        closing = False
+        while not closing:
+            timeout = None if deadline is None \
+                else max(0, deadline - time.monotonic())
+            try:
+                line = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                line = b''
+            if line is None or \
+                    (self.closing.is_set() and self.queue.empty()):
+                closing = True
+            if line:
+                if not batch:
+                    deadline = time.monotonic() + self.interval
+                batch.append(line)
+            if batch and (closing or len(batch) >= self.batch_size or
+                          time.monotonic() >= deadline):
+                self.send(batch)
+                batch, deadline = [], None
+        self.sink.close()
+
+    def send(self, batch):
+        try:
+            self.sink.send(b''.join(batch))
+        except OSError:
+            self.lost += len(batch)
+            self.sink.close()
+
+    def close(self, wait=0.1):
+        # Called on mitmproxy's event loop, so this doesn't wait
+        # for a slow collector: the thread sends what it has left
+        # and exits on its own. Returns the number of lines lost,
+        # counting those still waiting after `wait` seconds.
+        self.closing.set()
+        try:
+            # Wakes up the thread if it's waiting for lines. If the queue
+            # is full, the thread isn't waiting, and will see `closing`.
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+        self.thread.join(wait)
+        return self.lost + self.queue.qsize()
+
+
+def parse_destination(destination):
+    kind, _, where = destination.partition(':')
+    if kind == 'unix' and where:
+        return StreamSink(socket.AF_UNIX, where)
+    if kind == 'tcp':
+        host, _, port = where.rpartition(':')
+        if host and port.isdigit():
+            return StreamSink(socket.AF_INET, (host.strip('[]'), int(port)))
+    if kind == 'dir' and where:
+        return SpoolSink(os.path.expanduser(where))
+    raise ValueError(f'must be "unix:path", "tcp:host:port" or "dir:path", '
+                     f'not "{destination}"')
+
+
+class StreamSink:
+
+    """A Unix or TCP socket, connected when first needed."""
+
+    timeout = 5
+
+    def __init__(self, family, address):
+        self.family = family
+        self.address = address
+        self.sock = None
+
+    def send(self, data):
+        if self.sock is None:
+            if self.family == socket.AF_UNIX:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(self.timeout)
+                try:
+                    sock.connect(self.address)
+                except OSError:
+                    sock.close()
+                    raise
+                self.sock = sock
+            else:
+                # Also handles IPv6 and host names.
+                self.sock = socket.create_connection(self.address,
+                                                     self.timeout)
+        self.sock.sendall(data)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class SpoolSink:
+
+    """A directory where every batch becomes a file.
+
+    Files are named so that they sort in the order they were written,
+    and only get their ``.jsonl`` name once they are complete,
+    so a collector can pick them up (and delete them) as they appear.
+
+    """
+
+    timeout = 5
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+
+    def send(self, data):
+        self.count += 1
+        name = os.path.join(self.path, f'{int(time.time() * 1e6):017d}-'
+                                       f'{os.getpid()}-{self.count}')
+        with open(name + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(name + '.tmp', name + '.jsonl')
+
+    def close(self):
+        pass
+
+
+def check_and_render(exch, live=False):
+    # Also renders `exch`'s piece of the HTML report if `live`.
+    start = time.perf_counter()
+    httpolice.check_exchange(exch)
+    checked = time.perf_counter()
+    result = summarize(exch)
+    piece = render_piece(httpolice.html_report, exch) if live else None
+    times = {'check': checked - start, 'render': time.perf_counter() - checked}
+    return exch, result, piece, times
+
+
+class LiveReport:
+
+    """Pieces of an HTML report on the most recently checked flows.
+
+    The pieces are kept in a ring buffer, bounded both by their number
+    and by their total size, so putting them together is cheap.
+
+    """
+
     def __init__(self):
-        self.last_report = None
+        self.max_count = self.max_size = 0
+        self.size = 0
+        self.sections = collections.deque()
 
-    def load(self, loader):
-        loader.add_option(
-            name='httpolice_silence',
-            # ``typing.Sequence[int]`` would be better, but is not supported.
-            typespec=typing.Sequence[str],
-            default=[],
-            help='Silence these HTTPolice notice IDs.',
-        )
-        loader.add_option(
-            name='httpolice_mark',
-            # Could make this a ``typing.Optional[str]``, but
-            # that doesn't work well with the interactive editors,
-            # so make "disable" an explicit choice.
-            typespec=str,
-            choices=[''] + [sev.name for sev in httpolice.Severity],
-            default='',
-            help=
-                'Mark flows where HTTPolice found notices of this severity '
-                'or higher (empty to disable).'
+    def add(self, flow, notices, piece):
+        severity = max((sev for (_, sev) in notices), default=None)
+        self.sections.append((flow.request.host, severity, piece))
+        self.size += len(piece)
+        self.trim()
+
+    def resize(self, max_count, max_size):
+        self.max_count, self.max_size = max_count, max_size
+        self.trim()
+
+    def trim(self):
+        while self.sections and (len(self.sections) > self.max_count or
+                                 self.size > self.max_size):
+            (_, _, piece) = self.sections.popleft()
+            self.size -= len(piece)
+
+    def render(self, min_severity=None, host=None):
+        prologue, epilogue = report_frame(httpolice.html_report)
+        return b''.join(
+            [prologue] +
+            [piece for (piece_host, severity, piece) in self.sections
+             if (min_severity is None or
+                 (severity is not None and severity >= min_severity)) and
+             (host is None or piece_host == host)] +
+            [epilogue]
         )
 
-    def request(self, flow):
-        if flow.request.path == '/+httpolice/':
-            flow.response = self.serve_report()
 
-    def response(self, flow):
-        exch = flow_to_exchange(flow)
-        attach_report(exch, flow)
-        mark_exchange(exch, flow)
-        log_exchange(exch, flow)
+class StageTimes:
 
-    @mitmproxy.command.command('httpolice.report.html')
-    def html_report(self,
-                    flows: typing.Sequence[mitmproxy.flow.Flow],
-                    path: mitmproxy.types.Path) -> None:
-        """Produce an HTTPolice report (HTML) on flows."""
-        self.report(flows, httpolice.html_report, path)
+    """Histograms of the time taken by each stage of checking a flow.
 
-    @mitmproxy.command.command('httpolice.report.text')
-    def text_report(self,
-                    flows: typing.Sequence[mitmproxy.flow.Flow],
-                    path: mitmproxy.types.Path) -> None:
-        """Produce an HTTPolice report (text) on flows."""
-        self.report(flows, httpolice.text_report, path)
+    The stages are: ``build`` (converting the flow to an exchange),
+    ``check``, ``render`` (the notices for flow details), and ``finish``
+    (attaching them to the flow, marking, logging and so on).
 
-    def report(self, flows, report_func, path):
-        exchanges = (flow_to_exchange(flow) for flow in flows)
-        if path == '-':
-            buf = io.BytesIO()
-            report_func(exchanges, buf)
-            self.last_report = buf.getvalue()
-            ctx.log.alert(
-                f'HTTPolice: saved report on {len(flows)} flows in memory')
-        else:
-            with open(path, 'wb') as f:
-                report_func(exchanges, f)
-            ctx.log.alert(
-                f'HTTPolice: wrote report on {len(flows)} flows to {path}')
+    """
 
-    def serve_report(self):
-        if self.last_report is None:
-            status_code = HTTPStatus.NOT_FOUND.value
-            content = (
-                f'<!DOCTYPE html><p>No report has been <a href="'
-                f'https://mitmproxy-httpolice.readthedocs.io/en/{__version__}/'
-                f'walkthrough.html#inmemory">produced</a> yet.</p>'
-            ).encode('utf-8')
-        else:
-            status_code = HTTPStatus.OK.value
-            content = self.last_report
-        headers = {
-            'Date': email.utils.formatdate(usegmt=True),
-            'Content-Type': (
-                'text/html; charset=utf-8' if content.startswith(b'<!')
-                else 'text/plain; charset=utf-8'
-            ),
-            'Cache-Control': 'no-store',
-        }
-        return mitmproxy.http.HTTPResponse.wrap(
-            mitmproxy.net.http.Response.make(status_code, content, headers),
-        )
+    stages = ['build', 'check', 'render', 'finish']
+
+    # Upper bounds of the histogram buckets, in seconds.
+    bounds = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5,
+              float('inf')]
+
+    def __init__(self):
+        self.buckets = {stage: [0] * len(self.bounds) for stage in self.stages}
+        self.sums = dict.fromkeys(self.stages, 0.0)
+        self.maxima = dict.fromkeys(self.stages, 0.0)
 
+    def add(self, times):
+        for (stage, seconds) in times.items():
+            self.buckets[stage][bisect.bisect_left(self.bounds, seconds)] += 1
+            self.sums[stage] += seconds
+            self.maxima[stage] = max(self.maxima[stage], seconds)
 
-def flow_to_exchange(flow):
+    def summary(self):
+        # Pieces like "check: 1.2 ms avg, 34.5 ms max".
+        for stage in self.stages:
+            n = sum(self.buckets[stage])
+            if n:
+                yield (f'{stage}: {self.sums[stage] / n * 1000:.1f} ms avg, '
+                       f'{self.maxima[stage] * 1000:.1f} ms max')
+
+    def to_prometheus(self):
+        lines = ['# TYPE httpolice_stage_seconds histogram']
+        for stage in self.stages:
+            total = 0
+            for (bound, n) in zip(self.bounds, self.buckets[stage]):
+                total += n
+                le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                lines.append(f'httpolice_stage_seconds_bucket'
+                             f'{{stage="{stage}",le="{le}"}} {total}')
+            lines.append(f'httpolice_stage_seconds_sum{{stage="{stage}"}} '
+                         f'{self.sums[stage]}')
+            lines.append(f'httpolice_stage_seconds_count{{stage="{stage}"}} '
+                         f'{total}')
+        return '\n'.join(lines) + '\n'
+
+
+def flow_to_exchange(flow, silence):
+    exch = build_exchange(flow, silence)
+    httpolice.check_exchange(exch)
+    return exch
+
+
+def build_exchange(flow, silence):
     req = construct_request(flow)
     resp = construct_response(flow)
     exch = httpolice.Exchange(req, [resp] if resp else [])
-    exch.silence([int(id_) for id_ in ctx.options.httpolice_silence])
-    httpolice.check_exchange(exch)
+    exch.silence(silence)
     return exch
 
 
+class Policy:
+
+    """Which notices to silence and which flows to mark, compiled from options.
+
+    Rules for hosts and paths (``httpolice_silence_rules``
+    and ``httpolice_mark_rules``) are kept in `RuleIndex`es,
+    so that matching a flow against them doesn't take longer
+    with more rules.
+
+    """
+
+    def __init__(self, silence=(), silence_rules=(), mark='', mark_rules=()):
+        self.silence = frozenset(parse_ids(silence))
+        self.mark = parse_severity(mark)
+        self.silence_rules = RuleIndex()
+        for rule in silence_rules:
+            pattern, ids = parse_rule(rule)
+            self.silence_rules.add(pattern,
+                                   frozenset(parse_ids(ids.split(','))))
+        self.mark_rules = RuleIndex()
+        for rule in mark_rules:
+            pattern, severity = parse_rule(rule)
+            self.mark_rules.add(pattern, parse_severity(severity))
+
+    def silence_for(self, flow):
+        # Returns a set of notice IDs to silence on `flow`.
+        matches = self.silence_rules.match(flow.request.host,
+                                           flow.request.path)
+        return self.silence.union(*matches) if matches else self.silence
+
+    def mark_for(self, flow):
+        # Returns the minimum severity of notices to mark `flow`, or `None`.
+        matches = self.mark_rules.match(flow.request.host, flow.request.path)
+        # The most specific rule wins.
+        return matches[-1] if matches else self.mark
+
+
+class Selection:
+
+    """Which flows to include in reports, compiled from options.
+
+    A flow is included if it has at least one notice of the minimum severity
+    (``httpolice_report_severity``) and with one of the IDs
+    (``httpolice_report_ids``), and matches one of the host patterns
+    (``httpolice_report_hosts``, like in a `RuleIndex`).
+    Empty options don't restrict anything.
+
+    """
+
+    def __init__(self, min_severity='', ids=(), hosts=()):
+        self.min_severity = parse_severity(min_severity)
+        self.ids = frozenset(parse_ids(ids))
+        self.hosts = RuleIndex()
+        for pattern in hosts:
+            self.hosts.add(pattern.strip(), True)
+
+    def __bool__(self):
+        return bool(self.min_severity is not None or self.ids or self.hosts)
+
+    def wants_flow(self, flow):
+        # Only what can be known without checking the flow.
+        return self.wants_target(flow.request.host, flow.request.path)
+
+    def wants_target(self, host, path):
+        return not self.hosts or bool(self.hosts.match(host, path))
+
+    def wants_notices(self, notices):
+        if self.min_severity is None and not self.ids:
+            return True
+        return any((self.min_severity is None or
+                    severity >= self.min_severity) and
+                   (not self.ids or id_ in self.ids)
+                   for (id_, severity) in notices)
+
+
+def parse_ids(ids):
+    try:
+        return [int(id_) for id_ in ids]
+    except ValueError:
+        raise ValueError(f'notice IDs must be numbers: {", ".join(ids)}')
+
+
+def parse_severity(name):
+    # The empty string means "none".
+    if not name:
+        return None
+    try:
+        return httpolice.Severity[name]
+    except KeyError:
+        raise ValueError(f'unknown severity: {name}')
+
+
+def parse_rule(rule):
+    pattern, eq, value = rule.rpartition('=')
+    if not eq:
+        raise ValueError(f'rule must look like "host/path=value": {rule}')
+    return pattern.strip(), value.strip()
+
+
+class RuleIndex:
+
+    """Values for patterns of hosts and path prefixes.
+
+    Patterns look like ``example.com/api/``. The host can be ``*.example.com``
+    for any subdomain of ``example.com``, or ``*`` (or nothing) for any host.
+    The path prefix can be omitted, too.
+
+    Hosts are kept in a trie, by domain labels from the end,
+    and path prefixes in a `PathTable` for every host (or subdomain) pattern.
+    So matching costs about one dictionary lookup per domain label,
+    plus one per distinct prefix length, regardless of the number of rules.
+
+    """
+
+    def __init__(self):
+        self.root = HostNode()
+
+    def __bool__(self):
+        return bool(self.root)
+
+    def add(self, pattern, value):
+        host, slash, path = pattern.partition('/')
+        host = host.lower()
+        subdomains = host in ['', '*'] or host.startswith('*.')
+        if subdomains:
+            host = host[2:]
+        node = self.root
+        for label in reversed(host.split('.')) if host else []:
+            node = node.children.setdefault(label, HostNode())
+        table = node.subdomains if subdomains else node.exact
+        table.add(slash + path, value)
+
+    def match(self, host, path):
+        # Returns the values for all matching patterns,
+        # from the least specific to the most specific.
+        matches = []
+        if not self:
+            return matches
+        node = self.root
+        labels = host.lower().split('.')
+        node.subdomains.match(path, matches)
+        for (i, label) in enumerate(reversed(labels)):
+            node = node.children.get(label)
+            if node is None:
+                break
+            if i == len(labels) - 1:
+                node.exact.match(path, matches)
+            else:
+                node.subdomains.match(path, matches)
+        return matches
+
+
+class HostNode:
+
+    def __init__(self):
+        self.children = {}
+        self.exact = PathTable()
+        self.subdomains = PathTable()
+
+    def __bool__(self):
+        return bool(self.children or self.exact or self.subdomains)
+
+
+class PathTable:
+
+    """Values by path prefix."""
+
+    def __init__(self):
+        self.by_prefix = {}
+        self.lengths = []
+
+    def __bool__(self):
+        return bool(self.by_prefix)
+
+    def add(self, prefix, value):
+        self.by_prefix.setdefault(prefix, []).append(value)
+        if len(prefix) not in self.lengths:
+            bisect.insort(self.lengths, len(prefix))
+
+    def match(self, path, matches):
+        for length in self.lengths:
+            if length > len(path):
+                break
+            matches.extend(self.by_prefix.get(path[:length], []))
+
+
 def construct_request(flow):
-    version, headers, body = extract_message_basics(flow.request)
+    version, headers, pseudo_headers, body = \
+        extract_message_basics(flow.request)
     scheme = decode(flow.request.scheme)
     method = decode(flow.request.method)
 
@@ -121,14 +2422,12 @@ def construct_request(flow):
     # are simply rejected as errors by mitmproxy, closing the connection.
     target = decode(flow.request.path)
 
-    if version == 'HTTP/2':
-        pseudo_headers = httpolice.helpers.pop_pseudo_headers(headers)
-        authority = pseudo_headers.get(':authority')
-        has_host = any(k.lower() == 'host' for (k, v) in headers)
-        if authority and not has_host and target.startswith('/'):
-            # Reconstruct HTTP/2's equivalent of
-            # the "absolute form" of request target (RFC 7540 Section 8.1.2.3).
-            target = scheme + '://' + decode(authority) + target
+    authority = pseudo_headers.get(':authority')
+    if authority and target.startswith('/') and \
+            not any(k.lower() == 'host' for (k, v) in headers):
+        # Reconstruct HTTP/2's equivalent of
+        # the "absolute form" of request target (RFC 7540 Section 8.1.2.3).
+        target = scheme + '://' + decode(authority) + target
 
     return httpolice.Request(scheme, method, target, version, headers, body)
 
@@ -136,11 +2435,9 @@ def construct_request(flow):
 def construct_response(flow):
     if flow.response is None:
         return None
-    version, headers, body = extract_message_basics(flow.response)
+    version, headers, _, body = extract_message_basics(flow.response)
     status = flow.response.status_code
     reason = decode(flow.response.reason)
-    if version == 'HTTP/2':
-        httpolice.helpers.pop_pseudo_headers(headers)
     return httpolice.Response(version, status, reason, headers, body)
 
 
@@ -148,30 +2445,136 @@ def extract_message_basics(msg):
     version = decode(msg.http_version)
     if version == 'HTTP/2.0':
         version = 'HTTP/2'
-    headers = [(decode(k), v) for (k, v) in msg.headers.fields]
-    body = msg.raw_content
-    return version, headers, body
+    headers = []
+    pseudo_headers = {}
+    for (k, v) in msg.headers.fields:
+        k = header_name(k)
+        if version == 'HTTP/2' and k[:1] == ':':
+            # Same as ``httpolice.helpers.pop_pseudo_headers``,
+            # but without another pass over the headers.
+            pseudo_headers[k] = v
+        else:
+            headers.append((k, v))
+    # A body of `None` tells HTTPolice that it's unknown,
+    # so it will only check the headers.
+    # The body is not copied: HTTPolice gets the same `bytes` object.
+    body = None if why_unchecked(msg) else msg.raw_content
+    return version, headers, pseudo_headers, body
+
+
+_header_names = {}
+
+
+def header_name(raw):
+    # Most traffic uses only so many header names, so each of them
+    # is decoded once and then shared by all flows. A peer sending
+    # random names could grow this forever, hence the cap.
+    name = _header_names.get(raw)
+    if name is None:
+        name = sys.intern(decode(raw))
+        if len(_header_names) < 1000:
+            _header_names[raw] = name
+    return name
+
+
+def why_unchecked(msg):
+    if msg.raw_content is None:
+        return 'not captured (streamed?)'
+    max_body = ctx.options.httpolice_max_body
+    if max_body and len(msg.raw_content) > max_body:
+        return f'{len(msg.raw_content)} bytes is over httpolice_max_body'
+    body_types = ctx.options.httpolice_body_types
+    if body_types and msg.raw_content:
+        media_type = decode(msg.headers.get('Content-Type', ''))
+        media_type = media_type.partition(';')[0].strip().lower()
+        if not any(media_type_matches(media_type, pattern)
+                   for pattern in body_types):
+            return f'"{media_type}" is not in httpolice_body_types'
+    return None
 
 
-def attach_report(exch, flow):
+def media_type_matches(media_type, pattern):
+    pattern = pattern.strip().lower()
+    if pattern.endswith('/*'):
+        return media_type.startswith(pattern[:-1])
+    return media_type == pattern
+
+
+def render_piece(report_func, exch):
+    # Returns just the part of `report_func`'s report that is about `exch`,
+    # so that reports on many exchanges can be rendered piece by piece
+    # (for example, in parallel) and then put together.
+    prologue, epilogue = report_frame(report_func)
+    report = render(report_func, [exch])
+    if not (report.startswith(prologue) and report.endswith(epilogue)):
+        raise RuntimeError('cannot split HTTPolice report into pieces')
+    return report[len(prologue):(len(report) - len(epilogue))]
+
+
+@functools.lru_cache()
+def report_frame(report_func):
+    # Returns the parts of `report_func`'s reports that come before and after
+    # the exchanges. They don't depend on the exchanges, so we can find them
+    # by comparing an empty report to a report on one dummy exchange.
+    empty = render(report_func, [])
+    dummy = httpolice.Exchange(
+        httpolice.Request('http', 'GET', '/', 'HTTP/1.1', [], b''), [])
+    httpolice.check_exchange(dummy)
+    prologue = os.path.commonprefix([empty, render(report_func, [dummy])])
+    return prologue, empty[len(prologue):]
+
+
+def render(report_func, exchanges):
+    buf = io.BytesIO()
+    report_func(exchanges, buf)
+    return buf.getvalue()
+
+
+def report_lines(exch):
     buf = io.BytesIO()
     httpolice.text_report([exch], buf)
     report = buf.getvalue().decode('utf-8')
-    for_request, for_response = parse_report(report)
+    return parse_report(report)
+
+
+def attach_report(report, flow, preliminary=False):
+    # If `preliminary`, bodies that are still on their way
+    # will be checked later.
+    for_request, for_response = report
+    unchecked = []
+    for (name, msg) in [('request', flow.request),
+                        ('response', flow.response)]:
+        if msg is None:
+            continue
+        if preliminary and msg.raw_content is None and not msg.stream:
+            unchecked.append(f'{name} body: not received yet')
+        elif why_unchecked(msg):
+            unchecked.append(f'{name} body: {why_unchecked(msg)}')
     for title, lines in [('HTTPolice: request', for_request),
-                         ('HTTPolice: response', for_response)]:
-        if lines:
-            text = u'\n'.join(lines) + u'\n'
-            try:
-                # If this script is being run on a flow previously loaded
-                # from file, `flow.metadata` might already contain our keys
-                # in the wrong order. Reinsert them instead of just updating.
-                flow.metadata.pop(title, None)
-                flow.metadata[title] = ReprString(text)
-            except Exception:
-                # `flow.metadata` is not public API,
-                # so could theoretically fail.
-                pass
+                         ('HTTPolice: response', for_response),
+                         ('HTTPolice: not checked', unchecked)]:
+        try:
+            # If this script is being run on a flow previously loaded
+            # from file, `flow.metadata` might already contain our keys
+            # in the wrong order, or stale ones. Reinsert them instead
+            # of just updating.
+            flow.metadata.pop(title, None)
+            if lines:
+                flow.metadata[title] = ReportLines.of(lines)
+        except Exception:
+            # `flow.metadata` is not public API,
+            # so could theoretically fail.
+            pass
+
+
+def detach_report(flow):
+    # Remove the notices attached by a preliminary check.
+    for title in ['HTTPolice: request', 'HTTPolice: response',
+                  'HTTPolice: not checked']:
+        try:
+            flow.metadata.pop(title, None)
+        except Exception:
+            pass
 
 
 def parse_report(report):
@@ -196,40 +2599,102 @@ def parse_report(report):
     return for_request, for_response
 
 
-def mark_exchange(exch, flow):
-    if ctx.options.httpolice_mark:
-        mark_severity = httpolice.Severity[ctx.options.httpolice_mark]
-        if any(notice.severity >= mark_severity
-               for msg in [exch.request] + exch.responses
-               for notice in msg.notices):
-            flow.marked = True
+def mark_flow(notices, flow, policy):
+    mark_severity = policy.mark_for(flow)
+    if mark_severity is not None and \
+            any(severity >= mark_severity for (_, severity) in notices):
+        flow.marked = True
 
 
-def log_exchange(exch, flow):
+def log_flow(notices, flow):
     # Produce lines like "1 errors, 2 comments" without hardcoding severities.
-    severities = collections.Counter(notice.severity
-                                     for msg in [exch.request] + exch.responses
-                                     for notice in msg.notices)
+    severities = collections.Counter(severity for (_, severity) in notices)
     pieces = [f'{n} {severity.name}s'
               for (severity, n) in sorted(severities.items(), reverse=True)
               if severity > httpolice.Severity.debug]
     if pieces:
-        log_func = (ctx.log.warn
-                    if max(severities) >= httpolice.Severity.error
-                    else ctx.log.info)
-        log_func('HTTPolice: {0} in: {1} {2} ← {3}'.format(
+        log_func(max(severities))('HTTPolice: {0} in: {1} {2} ← {3}'.format(
             ', '.join(pieces),
             flow.request.method, ellipsize(flow.request.path),
             flow.response.status_code,
         ))
 
 
+def log_func(severity):
+    return ctx.log.warn if severity >= httpolice.Severity.error \
+        else ctx.log.info
+
+
+class LogCoalescer:
+
+    """Logs a summary of similar flows with notices, once in a while.
+
+    Flows are similar if they have the same host, method, `path_template`
+    and severities of notices (or other things to log about them,
+    see `count`). Every `window` seconds, one line is logged
+    for each kind of similar flows seen, up to `max_lines`;
+    the rest are only counted, so memory is bounded, too.
+
+    """
+
+    def __init__(self, window, max_lines):
+        self.window = window
+        self.max_lines = max_lines
+        self.counts = collections.OrderedDict()
+        self.others = 0
+        self.timer = None
+
+    def add(self, notices, flow):
+        severities = frozenset(severity for (_, severity) in notices
+                               if severity > httpolice.Severity.debug)
+        if severities:
+            self.count(flow, ', '.join(f'{severity.name}s' for severity
+                                       in sorted(severities, reverse=True)),
+                       max(severities))
+
+    def count(self, flow, what, severity):
+        # `what` is found in `flow`; `severity` decides how it's logged.
+        key = (flow.request.host, flow.request.method,
+               path_template(flow.request.path), what, severity)
+        if key in self.counts:
+            self.counts[key] += 1
+        elif len(self.counts) < self.max_lines:
+            self.counts[key] = 1
+        else:
+            self.others += 1
+        if self.timer is None:
+            self.timer = asyncio.get_event_loop().call_later(self.window,
+                                                             self.flush)
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        for ((host, method, path, what, severity), n) in self.counts.items():
+            log_func(severity)(
+                'HTTPolice: {0} in {1} {2}: {3} {4}{5}'.format(
+                    what, n, 'flow' if n == 1 else 'flows',
+                    method, host, ellipsize(path),
+                ))
+        if self.others:
+            ctx.log.info(f'HTTPolice: {self.others} more flows to log '
+                         f'(see httpolice_log_lines)')
+        self.counts.clear()
+        self.others = 0
+
+
 def decode(s):
     if isinstance(s, bytes):
         return s.decode('iso-8859-1')
     return s
 
 
+def encode(s):
+    if isinstance(s, str):
+        return s.encode('iso-8859-1', 'replace')
+    return s
+
+
 def ellipsize(s, max_length=40):
     if len(s) <= max_length:
         return s
@@ -237,21 +2702,211 @@ def ellipsize(s, max_length=40):
     return s[:(max_length - len(ellipsis))] + ellipsis
 
 
-class ReprString(str):
+class ReportLines(str):
+
+    """Lines of text to show in flow details.
+
+    Many flows get the same notices, so instead of joining the lines
+    into a new string for every flow, the text for each distinct set
+    of lines is shared between flows (see `shared_report_lines`).
+    Being a string, it is saved to a file as is.
+
+    """
 
     # Currently mitmproxy displays ``repr()`` in details view, not ``str()``.
     # See also https://discourse.mitmproxy.org/t/extending-the-ui/359/5
 
     __slots__ = []
 
+    @classmethod
+    def of(cls, lines):
+        if isinstance(lines, cls):
+            return lines
+        if not isinstance(lines, str):
+            lines = ''.join(line + '\n' for line in lines)
+        return shared_report_lines(lines)
+
     def __repr__(self):
         return str(self)
 
 
+@functools.lru_cache(maxsize=10000)
+def shared_report_lines(text):
+    return ReportLines(text)
+
+
+class StoredResult(str):
+
+    """What `store_result` saves with a flow, for `stored_notices`.
+
+    This is for us rather than for the user, so it is shown
+    in flow details as a short note instead of its contents.
+    When saved to a file, this becomes a plain string.
+
+    """
+
+    __slots__ = []
+
+    def __repr__(self):
+        return 'notices to reuse when this flow is loaded from a file\n'
+
+
 addons = [MitmproxyHTTPolice()]
 
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python3 -m mitmproxy_httpolice',
+        description=
+            'Without arguments, print the path to the mitmproxy-HTTPolice '
+            'addon, for use with "mitmproxy -s".')
+    subparsers = parser.add_subparsers(dest='command')
+    check_parser = subparsers.add_parser(
+        'check', help='check flows saved by mitmproxy and produce a report')
+    check_parser.add_argument('paths', metavar='path', nargs='+',
+                              help='mitmproxy flow file to read')
+    check_parser.add_argument('-o', '--output', default='-',
+                              help='write report to this file (default: '
+                                   'standard output)')
+    check_parser.add_argument('-f', '--format', default='text',
+                              choices=sorted(report_formats) + ['jsonl'],
+                              help='report format (default: text)')
+    check_parser.add_argument('-j', '--jobs', type=int,
+                              default=os.cpu_count(),
+                              help='number of worker processes '
+                                   '(default: number of CPUs)')
+    check_parser.add_argument('--set', dest='setoptions', default=[],
+                              action='append', metavar='option=value',
+                              help='set an httpolice_* option '
+                                   '(may be repeated)')
+    args = parser.parse_args(argv)
+    if args.command is None:
+        # Print the path to this script,
+        # for substitution into the mitmproxy command.
+        print(__file__)
+    else:
+        check_files(args.paths, args.format, args.output,
+                    args.jobs, args.setoptions)
+
+
+# Names of HTTPolice functions (see `LazyModule`).
+report_formats = {
+    'html': 'html_report',
+    'text': 'text_report',
+}
+
+
+def check_files(paths, format_, output, jobs, setoptions):
+    # Flows are read one by one and sent off to worker processes,
+    # which send back the pieces of the report, to be written in order.
+    # Only a few flows per worker are in flight at any time,
+    # so memory use doesn't depend on the size of the files.
+    addon = setup_headless(setoptions)
+    if jobs > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(jobs)
+        flows = (dump_flow(flow) for flow in read_flows(paths))
+        pieces = bounded_map(executor, check_flow_state, flows, jobs * 4,
+                             format_, setoptions)
+    else:
+        executor = None
+        pieces = (check_flow(flow, format_, addon.policy, addon.selection)
+                  for flow in read_flows(paths))
+    if format_ == 'jsonl':
+        prologue, epilogue = b'', b''
+    else:
+        prologue, epilogue = report_frame(
+            getattr(httpolice, report_formats[format_]))
+    out = sys.stdout.buffer if output == '-' else open(output, 'wb')
+    try:
+        out.write(prologue)
+        for piece in pieces:
+            out.write(piece)
+        out.write(epilogue)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+        if executor is not None:
+            executor.shutdown()
+
+
+def setup_headless(setoptions, values=None):
+    # Set up just enough of mitmproxy for our options to work via `ctx`.
+    opts = mitmproxy.options.Options()
+    master = mitmproxy.master.Master(opts)
+    addon = MitmproxyHTTPolice()
+    master.addons.add(addon)
+    opts.set(*setoptions)
+    if values:
+        opts.update(**values)
+    addon.configure(set(opts.keys()))
+    return addon
+
+
+def read_flows(paths):
+    for path in paths:
+        with open(path, 'rb') as f:
+            for flow in mitmproxy.io.FlowReader(f).stream():
+                if isinstance(flow, mitmproxy.http.HTTPFlow):
+                    yield flow
+
+
+# The addon that a worker process checks flows with,
+# set up on its first task by `check_flow_state`.
+worker_addon = None
+
+
+def dump_flow(flow):
+    # The state of a flow in mitmproxy may contain our own objects,
+    # such as `ReportLines`, which a worker process may not be able
+    # to unpickle (see `importable_self`). Serialized like in a flow file,
+    # they become plain lists and dicts.
+    return mitmproxy.io.tnetstring.dumps(flow.get_state())
+
+
+def check_flow_state(data, format_, setoptions, values=None):
+    # Runs in a worker process, on a flow from `dump_flow`. Options come
+    # as plain values rather than a ready `Policy`, so that nothing
+    # but the flow has to be pickled, and the pool needs no ``initializer``
+    # (which is new in Python 3.7).
+    global worker_addon                 # pylint: disable=global-statement
+    if worker_addon is None:
+        worker_addon = setup_headless(setoptions, values)
+    flow = mitmproxy.http.HTTPFlow.from_state(
+        mitmproxy.io.tnetstring.loads(data))
+    return check_flow(flow, format_,
+                      worker_addon.policy, worker_addon.selection)
+
+
+def check_flow(flow, format_, policy, selection=None):
+    # Returns the piece of the report on `flow`,
+    # which is empty if `selection` doesn't want it.
+    if selection and not selection.wants_flow(flow):
+        return b''
+    exch = None
+    notices = \
+        stored_notices(flow) if format_ == 'jsonl' or selection else None
+    if notices is None:
+        exch = flow_to_exchange(flow, policy.silence_for(flow))
+        notices = exchange_notices(exch)
+    if selection and not selection.wants_notices(notices):
+        return b''
+    if format_ == 'jsonl':
+        return jsonl_line(flow, notices)
+    if exch is None:
+        exch = flow_to_exchange(flow, policy.silence_for(flow))
+    return render_piece(getattr(httpolice, report_formats[format_]), exch)
+
+
+def bounded_map(executor, func, items, window, *args):
+    # Like ``executor.map``, but without submitting all `items` at once.
+    futures = collections.deque()
+    for item in items:
+        futures.append(executor.submit(func, item, *args))
+        if len(futures) >= window:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
 if __name__ == '__main__':
-    # Print the path to this script,
-    # for substitution into the mitmproxy command.
-    print(__file__)
+    main()
@@ -27,7 +27,8 @@ proc die {msg} {
 puts "spawning mitmproxy"
 spawn mitmproxy --confdir "$workdir/conf" --listen-port $port \
     --scripts $scriptpath \
-    --set httpolice_silence=1277 --set httpolice_mark=error
+    --set httpolice_silence=1277 --set httpolice_mark=error \
+    --set "httpolice_mark_rules=httpbin.org/stream/="
 expect ":$port"
 
 puts "running as HTTP/1.1 forward proxy"
@@ -41,6 +42,16 @@ expect {
     timeout {die "no mark on flows with errors!"}
 }
 
+puts "checking mark rules"
+# only the response-headers flow is marked, so it moves to the top
+send ":set view_filter=~marked\r"
+expect {
+    "stream/10" {die "marked a flow despite httpolice_mark_rules!"}
+    "response-headers" {}
+    timeout {die "mark rules not applied!"}
+}
+send ":set view_filter=\r"
+
 puts "running as HTTP/1.1 reverse proxy"
 send ":set mode=reverse:http://httpd.apache.org\r"
 sleep 1
@@ -75,10 +86,12 @@ exec {*}$nghttp "https://localhost:$port/"
 puts "generating reports"
 send ":httpolice.report.html @all $reportpath.html\r"
 send ":httpolice.report.text @all $reportpath.txt\r"
+send ":httpolice.report.jsonl @all $reportpath.jsonl\r"
 expect {
     "HTTPolice: wrote report on" {}
     timeout {die "no acknowledgement alert from command!"}
 }
+send ":save.file @all $workdir/flows\r"
 
 puts "checking flow details UI"
 # enter the first flow and go to its Details pane
@@ -111,6 +124,7 @@ puts "checking reports"
 exec grep -F "!DOCTYPE html" "$reportpath.html"
 exec grep -F "Bad JSON body" "$reportpath.html"
 exec grep -F "E 1038 Bad JSON body" "$reportpath.txt"
+exec grep -F {"id": 1038, "severity": "error"} "$reportpath.jsonl"
 exec grep -F "as part of entity-tag" "$reportpath.html"
 exec grep -F "E 1000 Syntax error in ETag header" "$reportpath.txt"
 exec grep -F "test.invalid" "$reportpath.html"
@@ -122,6 +136,34 @@ exec grep -F "HTTP/2" "$reportpath.html"
 exec grep -F "https://h2o.examp1e.net/assets/" "$reportpath.html"
 exec grep -F "GET https://h2o.examp1e.net/assets/" "$reportpath.txt"
 
+puts "checking saved flows from the command line"
+exec python -m mitmproxy_httpolice check -j 2 -o "$reportpath.cli.txt" \
+    "$workdir/flows"
+exec grep -F "E 1038 Bad JSON body" "$reportpath.cli.txt"
+exec grep -F "E 1000 Syntax error in ETag header" "$reportpath.cli.txt"
+
+puts "checking silence rules"
+exec python -m mitmproxy_httpolice check -j 1 -o "$reportpath.rules.txt" \
+    --set "httpolice_silence_rules=httpbin.org/response-headers=1000" \
+    "$workdir/flows"
+exec grep -F "E 1038 Bad JSON body" "$reportpath.rules.txt"
+if {![catch {exec grep -F "E 1000" "$reportpath.rules.txt"}]} {
+    die "got notice 1000 despite httpolice_silence_rules!"
+}
+
+puts "loading saved flows"
+spawn mitmproxy --confdir "$workdir/conf" --listen-port $port \
+    --scripts $scriptpath --rfile "$workdir/flows" \
+    --set httpolice_silence=1277 --set httpolice_mark=error
+expect ":$port"
+send ":httpolice.stats\r"
+expect {
+    "stored hits" {}
+    timeout {die "flows loaded from a file were checked again!"}
+}
+send ":console.exit\r"
+wait
+
 puts "all tests OK"
 
 exec rm -rf $workdir
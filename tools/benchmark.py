@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+"""Measure how fast mitmproxy-HTTPolice is, on synthetic or recorded flows.
+
+Run from the repo root::
+
+  $ python tools/benchmark.py
+
+No network access or running mitmproxy is needed. Every scenario
+is reported with throughput, per-flow latency percentiles, and peak memory
+(as seen by ``tracemalloc``, in a separate run). The ``startup`` and
+``reload`` scenarios count starts and reloads of the addon instead of flows.
+
+To see if a change makes things slower, save the results before the change
+and compare after it::
+
+  $ python tools/benchmark.py --save baseline.json
+  $ python tools/benchmark.py --compare baseline.json
+
+The exit status is 1 if any scenario got slower than ``--tolerance``.
+"""
+
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from mitmproxy.net.http import Headers
+from mitmproxy.test import taddons, tflow, tutils
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import mitmproxy_httpolice             # pylint: disable=wrong-import-position
+
+
+def h1_flow(body_size=17, extra_headers=0):
+    # A flow with a few notices on both the request and the response.
+    body = b'{"hello": "world"' + b' ' * (body_size - 17)
+    req = tutils.treq(content=body, headers=Headers([
+        (b'Host', b'example.com'),
+        (b'User-Agent', b'benchmark'),
+        (b'Content-Type', b'application/json'),
+        (b'Content-Length', b'%d' % len(body)),
+    ] + [(b'X-Extra-%d' % i, b'value %d' % i) for i in range(extra_headers)]))
+    resp = tutils.tresp(content=b'{}', headers=Headers([
+        (b'Date', b'Thu, 27 Jun 2019 12:00:00 GMT'),
+        (b'Content-Type', b'application/json'),
+        (b'Content-Length', b'2'),
+        (b'ETag', b'123'),
+        (b'Cache-Control', b'max-age=60, max-age=60'),
+    ]))
+    return tflow.tflow(req=req, resp=resp)
+
+
+def h2_flow(extra_headers=0):
+    flow = h1_flow(extra_headers=extra_headers)
+    for msg in [flow.request, flow.response]:
+        msg.http_version = 'HTTP/2.0'
+        del msg.headers['Content-Length']
+    flow.request.headers.insert(0, ':method', 'GET')
+    flow.request.headers.insert(1, ':scheme', 'https')
+    flow.request.headers.insert(2, ':authority', 'example.com')
+    flow.request.headers.insert(3, ':path', '/path')
+    del flow.request.headers['Host']
+    flow.response.headers.insert(0, ':status', '200')
+    return flow
+
+
+synthetic = {
+    'h1': h1_flow,
+    'h1-large-body': lambda: h1_flow(body_size=1024 * 1024),
+    'h1-many-headers': lambda: h1_flow(extra_headers=100),
+    'h2': h2_flow,
+    'h2-many-headers': lambda: h2_flow(extra_headers=100),
+}
+
+
+def bench_response(flows, **options):
+    """All hooks on a flow, as on every flow passing through mitmproxy."""
+    addon = mitmproxy_httpolice.MitmproxyHTTPolice()
+    with taddons.context(addon) as tctx:
+        addon.configure(set(tctx.options.keys()))
+        if options:
+            tctx.configure(addon, **options)
+        return [timed(load_flow, tctx.master, flow) for flow in flows]
+
+
+def bench_build(flows):
+    """Converting flows to HTTPolice exchanges, without checking them."""
+    addon = mitmproxy_httpolice.MitmproxyHTTPolice()
+    with taddons.context(addon) as tctx:
+        addon.configure(set(tctx.options.keys()))
+        return [timed(mitmproxy_httpolice.build_exchange, flow, frozenset())
+                for flow in flows]
+
+
+def bench_report(flows, format_, **options):
+    """A report on all `flows`, which have been checked already."""
+    addon = mitmproxy_httpolice.MitmproxyHTTPolice()
+    with taddons.context(addon) as tctx:
+        addon.configure(set(tctx.options.keys()))
+        if options:
+            tctx.configure(addon, **options)
+        for flow in flows:
+            load_flow(tctx.master, flow)
+        tctx.master.clear()
+        # Spread the time of the whole report evenly over its flows.
+        total = timed(addon.report, flows, format_, os.devnull)
+        return [total / len(flows)] * len(flows)
+
+
+def load_flow(master, flow):
+    # Goes through all the hooks for `flow`, with the ``update`` event
+    # that mitmproxy sends after each, rather than calling our hooks
+    # directly, which would skip what mitmproxy does in between.
+    result = master.load_flow(flow)
+    if asyncio.iscoroutine(result):         # mitmproxy 5
+        asyncio.get_event_loop().run_until_complete(result)
+
+
+def bench_notices(flows):
+    """Rendering notice lines for flow details (already checked)."""
+    exchanges = []
+    addon = mitmproxy_httpolice.MitmproxyHTTPolice()
+    with taddons.context(addon) as tctx:
+        addon.configure(set(tctx.options.keys()))
+        for flow in flows:
+            exchanges.append(mitmproxy_httpolice.flow_to_exchange(
+                flow, addon.policy.silence_for(flow)))
+    return [timed(mitmproxy_httpolice.report_lines, exch)
+            for exch in exchanges]
+
+
+def bench_startup(runs=5):
+    """Importing and loading the addon in a fresh Python, as ``-s`` does."""
+    code = ('from mitmproxy.test import taddons; import mitmproxy_httpolice; '
+            'addon = mitmproxy_httpolice.MitmproxyHTTPolice(); '
+            'tctx = taddons.context(addon); '
+            'addon.configure(set(tctx.options.keys()))')
+    repo = os.path.join(os.path.dirname(__file__), os.pardir)
+    return [timed(lambda: subprocess.run([sys.executable, '-c', code],
+                                         cwd=repo, check=True))
+            for _ in range(runs)]
+
+
+def bench_reload(runs=20):
+    """Reloading the addon, as mitmproxy does when the script changes."""
+    return [timed(importlib.reload, mitmproxy_httpolice) for _ in range(runs)]
+
+
+def scenarios(make_flows):
+    # Yields ``(name, run)``, where ``run()`` returns per-flow latencies.
+    # Every run gets fresh flows and a fresh addon.
+    for (kind, flows) in make_flows.items():
+        yield (f'response {kind}', lambda flows=flows: bench_response(flows()))
+    for (kind, flows) in make_flows.items():
+        yield (f'build {kind}', lambda flows=flows: bench_build(flows()))
+    first = list(make_flows.values())[0]
+    yield ('response dedupe',
+           lambda: bench_response(first(), httpolice_dedupe=1000))
+    yield ('report html', lambda: bench_report(first(), 'html'))
+    yield ('report text', lambda: bench_report(first(), 'text'))
+    yield ('report cached',
+           lambda: bench_report(first(), 'html',
+                                httpolice_cache=64 * 1024 * 1024))
+    # With the cache disabled, only the stored notices help here.
+    yield ('report selected',
+           lambda: bench_report(first(), 'html',
+                                httpolice_report_ids=['1']))
+    yield ('notice lines', lambda: bench_notices(first()))
+    # These are per start or reload, not per flow.
+    yield ('startup', bench_startup)
+    yield ('reload', bench_reload)
+
+
+def measure(run):
+    latencies = sorted(run())
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'flows/s': len(latencies) / sum(latencies),
+        'p50 ms': percentile(latencies, 50) * 1000,
+        'p90 ms': percentile(latencies, 90) * 1000,
+        'p99 ms': percentile(latencies, 99) * 1000,
+        'peak MiB': peak / 1024 / 1024,
+    }
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1,
+                             len(sorted_values) * p // 100)]
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def compare(results, baseline, tolerance):
+    # Returns the names of scenarios that got slower.
+    regressions = []
+    for (name, metrics) in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]['flows/s']
+        new = metrics['flows/s']
+        change = new / old - 1
+        print(f'{name:24} {old:10.1f} -> {new:10.1f} flows/s ({change:+.0%})')
+        if change < -tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', type=int, default=300,
+                        help='number of synthetic flows per scenario')
+    parser.add_argument('--flows', metavar='FILE',
+                        help='run on flows recorded by mitmproxy, too')
+    parser.add_argument('--save', metavar='FILE',
+                        help='save results as a baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare results to a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='slowdown to tolerate when comparing '
+                             '(default: 0.1, that is, 10%%)')
+    args = parser.parse_args()
+
+    make_flows = {
+        kind: (lambda make=make: [make() for _ in range(args.n)])
+        for (kind, make) in synthetic.items()
+    }
+    if args.flows:
+        make_flows['recorded'] = \
+            lambda: list(mitmproxy_httpolice.read_flows([args.flows]))
+
+    results = {}
+    for (name, run) in scenarios(make_flows):
+        results[name] = metrics = measure(run)
+        print(f'{name:24}' + ''.join(f'{value:10.2f} {metric}'
+                                     for (metric, value) in metrics.items()))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+"""A stand-in collector for ``httpolice_export``, for trying it out locally.
+
+Listens on a Unix socket or a TCP port and prints every record it gets,
+or counts them with ``--count``::
+
+  $ python tools/collector.py unix:/tmp/httpolice.sock
+  $ mitmproxy -s mitmproxy_httpolice.py \
+  >   --set httpolice_export=unix:/tmp/httpolice.sock
+
+With ``--slow``, it waits that many seconds after every record,
+to see how mitmproxy-HTTPolice copes with a slow collector.
+"""
+
+import argparse
+import json
+import os
+import socketserver
+import sys
+import time
+
+
+class Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            record = json.loads(line)
+            self.server.received += 1
+            if self.server.args.count:
+                print(f'\r{self.server.received} records', end='',
+                      flush=True)
+            else:
+                print(json.dumps(record, ensure_ascii=False), flush=True)
+            time.sleep(self.server.args.slow)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('address',
+                        help='"unix:/path/to/socket" or "tcp:host:port"')
+    parser.add_argument('--count', action='store_true',
+                        help='only count records')
+    parser.add_argument('--slow', type=float, default=0,
+                        help='seconds to wait after every record')
+    args = parser.parse_args()
+
+    kind, _, where = args.address.partition(':')
+    if kind == 'unix':
+        if os.path.exists(where):
+            os.remove(where)
+        server = socketserver.ThreadingUnixStreamServer(where, Handler)
+    elif kind == 'tcp':
+        host, _, port = where.rpartition(':')
+        server = socketserver.ThreadingTCPServer((host, int(port)), Handler)
+    else:
+        sys.exit(f'bad address: {args.address}')
+    server.args = args
+    server.received = 0
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()